@@ -0,0 +1,152 @@
+'''Benchmarks for opterator: decorating (and building the parser for)
+synthetic entry points with 1 to 1000 parameters, invoking them, rendering
+their help, and the peak memory used doing so.
+
+Results are compared to a stored baseline and the run fails if any
+measurement is slower (or bigger) than the baseline by more than the
+tolerance factor. Timings depend on the machine, so refresh the baseline
+with --update when benchmarking on new hardware.
+
+  $ python benchmarks/bench_opterator.py
+  $ python benchmarks/bench_opterator.py --update
+'''
+from __future__ import print_function
+
+import json
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from opterator import opterate  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+SIZES = (1, 10, 100, 1000)
+WORDS = ('alfa', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf',
+         'hotel', 'india', 'juliet', 'kilo', 'lima', 'mike', 'november')
+DEFAULTS = ('False', 'True', "'text'", 'None', '[]', "['one', 'two']")
+HELP_TEXT = ('controls how the synthetic command treats this option when it '
+             'processes its input, described at some length so that help '
+             'rendering has to wrap the text over several lines')
+
+
+def synthetic_function(size, seed=0):
+    '''Return an undecorated function with size parameters: a few positional
+    ones, the rest keyword parameters with mixed defaults, some annotated
+    with option names, most documented with a long help text, and varargs.
+    Also returns an argument list that invokes it.'''
+    rng = random.Random(seed)
+    positional = max(1, size // 10)
+    params = []
+    argv = []
+    doc = ['A synthetic command with %d parameters. ' % size + HELP_TEXT, '']
+    for index in range(size):
+        name = '%s_%d' % (rng.choice(WORDS), index)
+        if index < positional:
+            params.append(name)
+            argv.append('value%d' % index)
+            doc.append(':param %s: the %s positional %s' % (
+                name, name, HELP_TEXT))
+            continue
+        default = rng.choice(DEFAULTS)
+        if rng.random() < 0.2:
+            params.append("%s: ['--opt-%d']=%s" % (name, index, default))
+        else:
+            params.append('%s=%s' % (name, default))
+        if rng.random() < 0.8:
+            doc.append(':param %s: %s' % (name, HELP_TEXT))
+        if default == 'False' and len(argv) < positional + 10:
+            argv.append('--opt-%d' % index if params[-1].startswith(
+                name + ':') else '--' + name)
+    source = 'def main(%s, *rest):\n    %r\n    return len(rest)\n' % (
+        ', '.join(params), '\n'.join(doc))
+    namespace = {}
+    exec(source, namespace)
+    return namespace['main'], argv
+
+
+def best_of(function, repeat, number=1):
+    return min(timeit.repeat(function, repeat=repeat, number=number)) / number
+
+
+def decorate(func):
+    command = opterate(func)
+    command.build()
+    return command
+
+
+def render_help(command):
+    # Not command(['-h']), which prints help the command has already
+    # rendered once.
+    return command.build().format_help()
+
+
+def run_benchmarks(sizes, repeat):
+    results = {}
+    for size in sizes:
+        func, argv = synthetic_function(size)
+        results['decorate/%d' % size] = best_of(
+            lambda: decorate(func), repeat)
+        command = decorate(func)
+        results['call/%d' % size] = best_of(
+            lambda: command(argv), repeat, number=10)
+        results['help/%d' % size] = best_of(
+            lambda: render_help(command), repeat)
+
+        tracemalloc.start()
+        command = decorate(func)
+        command(argv)
+        render_help(command)
+        results['peak_memory/%d' % size] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''Return a list of descriptions of results that regressed.'''
+    regressions = []
+    for name, value in sorted(results.items()):
+        expected = baseline.get(name)
+        if expected and value > expected * tolerance:
+            regressions.append('%s: %.6g vs baseline %.6g' % (
+                name, value, expected))
+    return regressions
+
+
+@opterate
+def main(baseline=DEFAULT_BASELINE, tolerance='2.0', repeat='5',
+         size=[], update=False):
+    '''Benchmark opterator against a stored baseline.
+
+    :param baseline: -b --baseline the baseline JSON file
+    :param tolerance: -t --tolerance fail if a measurement exceeds the
+        baseline by more than this factor
+    :param repeat: -r --repeat number of repetitions to take the best of
+    :param size: -s --size number of parameters to benchmark; may be
+        repeated, defaults to 1, 10, 100 and 1000
+    :param update: -u --update write the results as the new baseline'''
+    sizes = [int(s) for s in size] or SIZES
+    results = run_benchmarks(sizes, int(repeat))
+    for name, value in sorted(results.items()):
+        print('%-20s %.6g' % (name, value))
+
+    if update:
+        with open(baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+        return
+    with open(baseline) as baseline_file:
+        regressions = compare(
+            results, json.load(baseline_file), float(tolerance))
+    if regressions:
+        print('\nRegressions beyond %sx the baseline:' % tolerance)
+        for regression in regressions:
+            print('  ' + regression)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,12 +19,29 @@
 # THE SOFTWARE.
 
 
-from argparse import ArgumentParser
-import inspect
+import marshal
+import os
 import sys
+import time
+
+try:
+    import _thread
+except ImportError:  # PYTHON 2 MUST DIE
+    import thread as _thread
 
 __version__ = "0.5"
 
+# Flags set on code objects that accept *args and of async def functions
+# (see the inspect module).
+CO_VARARGS = 0x04
+CO_COROUTINE = 0x80
+
+if hasattr(time, 'perf_counter_ns'):
+    _clock_ns = time.perf_counter_ns
+else:
+    def _clock_ns():
+        return int(time.time() * 1e9)
+
 
 def generate_options():
     '''Helper coroutine to identify short options that haven't been used
@@ -36,6 +53,9 @@ def generate_options():
     x = generate_options()
     next(x)  # advance coroutine past its initialization code
     params = x.send(param_name)
+
+    opterate uses allocate_options instead, which also knows about the
+    option strings claimed explicitly by other parameters.
     '''
     used_short_options = set()
     param_name = yield
@@ -49,6 +69,43 @@ def generate_options():
         param_name = yield names
 
 
+def allocate_options(params, explicit=None, fallback=False, reserved=()):
+    '''Return a dict mapping each name in params to its list of option
+    strings. Parameters with option strings in explicit (a dict of
+    param_name: option_strings) keep them. The others get a long option from
+    their name and the first letter of the name not already used as a short
+    option, either explicitly, by -h, by an option string in reserved or by
+    an earlier parameter. If fallback is True and all of a name's letters
+    are taken, the other case of each letter and then the digits are tried
+    as well.'''
+    explicit = explicit or {}
+    taken = set(['-h', '--help'])
+    taken.update(reserved)
+    for names in explicit.values():
+        taken.update(names)
+    allocated = {}
+    for param in params:
+        if param in explicit:
+            allocated[param] = list(explicit[param])
+            continue
+        candidates = param
+        if fallback:
+            candidates = param + param.swapcase() + '0123456789'
+        names = []
+        for letter in candidates:
+            short = '-' + letter
+            if short not in taken:
+                taken.add(short)
+                names.append(short)
+                break
+        long_name = '--' + param
+        if long_name not in taken or not names:
+            taken.add(long_name)
+            names.append(long_name)
+        allocated[param] = names
+    return allocated
+
+
 def portable_argspec(func):
     '''
     Given a function, return a tuple of
@@ -61,13 +118,25 @@ def portable_argspec(func):
     * annotations is a dictionary of param_name: annotation pairs
         it may be empty, and on python 2 will always be empty.
 
-    This function is portable between Python 2 and Python 3, and does some
-    extra processing of the output from inspect.
+    This function is portable between Python 2 and Python 3. For plain
+    functions it reads the code object directly rather than importing
+    inspect, which is comparatively expensive to import.
     '''
-    if sys.version_info < (3, 0):  # PYTHON 2 MUST DIE
+    code = getattr(func, '__code__', None)
+    if code is not None:
+        argnames = list(code.co_varnames[:code.co_argcount])
+        varargs = None
+        if code.co_flags & CO_VARARGS:
+            varargs = code.co_varnames[
+                code.co_argcount + getattr(code, 'co_kwonlyargcount', 0)]
+        defaults = func.__defaults__
+        annotations = dict(getattr(func, '__annotations__', None) or {})
+    elif sys.version_info < (3, 0):  # PYTHON 2 MUST DIE
+        import inspect
         argnames, varargs, varkw, defaults = inspect.getargspec(func)
         annotations = {}
     else:
+        import inspect
         (
             argnames, varargs, varkw, defaults, kwa, kwd, annotations
         ) = inspect.getfullargspec(func)
@@ -78,7 +147,12 @@ def portable_argspec(func):
     return positional_params, kw_params, varargs, defaults, annotations
 
 
-def opterate(func):
+def opterate(func=None, spec_cache=None, engine='argparse', on_phase=None,
+             short_option_fallback=False, vectorize=False,
+             stream_varargs=False, fast_loop=False, parallel=None,
+             executor='thread', ordered_output=False, config=None,
+             env_prefix=None, diagnostics=False, telemetry=None, cache=None,
+             cache_files='mtime', cache_size=64 << 20):
     '''A decorator for a main function entry point to a script. It
     automatically generates the options for the main entry point based on the
     arguments, keyword arguments, and docstring.
@@ -107,69 +181,2620 @@ def opterate(func):
     the format is:
     :param name: [short option and/or long option] help text
 
+    Google style (an Args: section) and NumPy style (a Parameters section)
+    docstrings are understood as well; the option strings go at the start of
+    each parameter's description.
+
     Variable_name is the name of the variable in the function specification and
     must refer to a keyword argument. All options must have a :param: line like
     this. If you can have an arbitrary length of positional arguments, add a
     *arglist variable; It can be named with any valid python identifier.
 
-    See opterator_test.py and examples/ for some examples.'''
-    (
-        positional_params, kw_params, varargs, defaults, annotations
-    ) = portable_argspec(func)
-
-    description = ''
-    param_docs = {}
-    if func.__doc__:
-        param_doc = func.__doc__.split(':param')
-        description = param_doc.pop(0).strip()
-        for param in param_doc:
-            param_args = param.split()
-            variable_name = param_args.pop(0)[:-1]
-            param_docs[variable_name] = param_args
-
-    parser = ArgumentParser(description=description)
-    option_generator = generate_options()
-    next(option_generator)
-
-    for param in positional_params:
-        parser.add_argument(param, help=" ".join(param_docs.get(param, [])))
-    for param in kw_params:
-        default = defaults[kw_params.index(param)]
-        names = []
-        param_doc = []
-        if param in annotations:
-            names = annotations[param]
-        if param in param_docs:
-            param_doc = param_docs.get(param, [])
-            while param_doc and param_doc[0].startswith('-'):
-                names.append(param_doc.pop(0))
-
-        names = names if names else option_generator.send(param)
-
-        option_kwargs = {
-            'action': 'store',
-            'help': ' '.join(param_doc),
-            'dest': param,
-            'default': default
-        }
-        if default is False:
-            option_kwargs['action'] = 'store_true'
-        elif default is True:
-            option_kwargs['action'] = 'store_false'
+    See opterator_test.py and examples/ for some examples.
+
+    Nothing is introspected when the decorator is applied; the parser is
+    built on the first call of the returned Command (or by calling its
+    build() method) and reused afterwards.
+
+    opterate can also be called with keyword arguments to configure the
+    command, for example @opterate(spec_cache=True):
+
+    * spec_cache: a directory in which the introspected spec is stored so
+      later processes can skip introspection. True uses the default cache
+      directory. When not given, the OPTERATOR_CACHE_DIR environment variable
+      is used if set.
+    * engine: 'argparse' (the default) or 'fast'. The fast engine parses
+      simple command lines in a single pass without ArgumentParser, handing
+      anything it doesn't understand (including -h and errors) to argparse
+      so help and error output are unchanged.
+    * on_phase: a callable that is passed the name and the elapsed wall time
+      in nanoseconds of each phase of building and running the command:
+      'spec_cache', 'argspec', 'docstring', 'options', 'add_arguments',
+      'parse' and 'call'. Setting the OPTERATOR_TRACE environment variable
+      to 1 (or to a file name) prints the timings as JSON lines to stderr
+      (or appends them to the file).
+    * short_option_fallback: when all the letters of a parameter's name are
+      already taken as short options, try the other case of each letter and
+      then the digits before giving it only a long option.
+    * vectorize: collect repeatable int or float options into an
+      array.array ('array') or a NumPy array ('numpy') converted in one go,
+      instead of a list of Python numbers. True uses NumPy if it is
+      installed.
+    * stream_varargs: read *varargs lazily. An @path argument stands for
+      the lines of that file and - for the lines of standard input. The
+      function receives a single varargs value, an iterator over all of
+      them, so nothing is read until it is consumed. See
+      iter_arguments.
+    * fast_loop: run async def functions on uvloop if it is installed.
+    * parallel: 'varargs' adds a -j/--jobs N option and calls the function
+      once for each varargs item, with that item as the only varargs value,
+      running N calls at once (one per CPU if N is 0; the default is 1).
+      The command returns the highest exit status of the calls, taking
+      their return values and SystemExit codes as sys.exit would and
+      reporting exceptions with status 1.
+    * executor: 'thread' (the default) or 'process' to run parallel calls
+      in forked processes.
+    * ordered_output: buffer what each parallel call writes to stdout and
+      stderr and write it out in the order of the items.
+    * config: the path, or a list of paths, of files that override the
+      defaults of options, read when the command is called. Files that
+      don't exist are skipped and later files take precedence. The settings
+      are read from the section (or table) named after the function, in
+      TOML (.toml), JSON (.json) or INI format (anything else). Keys are
+      parameter names and values are converted like command line values;
+      list options also accept comma separated strings, and flags accept
+      true/false, yes/no, on/off or 1/0. Parsed files are cached in the
+      spec cache directory (or the default one) until they are modified.
+    * env_prefix: if given, the environment variable PREFIX_NAME overrides
+      the config files for the option of parameter name.
+    * diagnostics: add the hidden options --opterator-profile PATH, which
+      runs the function under cProfile and writes the stats to PATH (read
+      them with the pstats module), and --opterator-tracemalloc PATH, which
+      traces memory allocations and writes a report of the top
+      TRACEMALLOC_TOP lines to PATH. Setting the OPTERATOR_DIAGNOSTICS
+      environment variable adds them to every command.
+    * telemetry: where to send a record of each call of the command, as a
+      line of JSON: the name of a file to append to, or unix:PATH for a
+      Unix datagram socket. Defaults to the OPTERATOR_TELEMETRY environment
+      variable. See record_usage for the fields.
+    * cache: memoize the results of calls in a directory, or in the
+      default cache directory if True. Only use it for commands that
+      depend on nothing but their arguments and the files they name. The
+      key is made of the function, the working directory, the parsed
+      values and, for each positional or varargs value naming a file, its
+      mtime and size (or a hash of its contents if cache_files is 'hash').
+      A repeated call writes the stdout and stderr text recorded the first
+      time and returns the same value or raises the same SystemExit. With
+      parallel, each item's output is written once the item is done, as
+      with ordered_output.
+      Calls that raise other exceptions, or whose value marshal can't
+      store, are not cached. The least recently used results are removed
+      when the directory holds more than cache_size bytes.
+
+    An async def function is run to completion in a new event loop each time
+    the command is called. From code already running in an event loop, await
+    command.run_async(argv) instead.'''
+    options = dict(spec_cache=spec_cache, engine=engine, on_phase=on_phase,
+                   short_option_fallback=short_option_fallback,
+                   vectorize=vectorize, stream_varargs=stream_varargs,
+                   fast_loop=fast_loop, parallel=parallel, executor=executor,
+                   ordered_output=ordered_output, config=config,
+                   env_prefix=env_prefix, diagnostics=diagnostics,
+                   telemetry=telemetry, cache=cache, cache_files=cache_files,
+                   cache_size=cache_size)
+    if func is None:
+        return lambda func: Command(func, **options)
+    return Command(func, **options)
+
+
+def cache_directory(setting=None):
+    '''Return the directory opterator caches should be written to, or None if
+    caching is disabled. setting may be a path, True for the default location
+    or None to defer to the OPTERATOR_CACHE_DIR environment variable.'''
+    if setting is None or setting is True:
+        path = os.environ.get('OPTERATOR_CACHE_DIR')
+        if path:
+            return os.path.expanduser(path)
+        if setting is None:
+            return None
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+            os.path.expanduser('~'), '.cache')
+        return os.path.join(base, 'opterator')
+    if setting is False:
+        return None
+    return os.path.expanduser(setting)
+
+
+def _defaults_shape(defaults):
+    '''Summarize the default values to the extent that they influence the
+    generated options, for use in cache keys.'''
+    shape = []
+    for default in defaults or ():
+        if default is True or default is False:
+            shape.append(repr(default))
         elif type(default) in (list, tuple):
-            if default:
-                option_kwargs['choices'] = default
+            # Choices are converted to the type of the first one.
+            shape.append('list:%s' % type(default[0]).__name__
+                         if default else 'empty')
+        else:
+            shape.append(type(default).__name__)
+    return ','.join(shape)
+
+
+def _annotations_shape(annotations):
+    '''Summarize annotations as the option strings and types they give
+    their parameters, for use in cache keys. Types are named by module and
+    qualified name; their reprs may contain addresses that differ between
+    processes.'''
+    shape = []
+    for param, annotation in sorted(annotations.items()):
+        names, converter = _annotation_parts(annotation)
+        try:
+            reference = _type_reference(converter)
+        except ValueError:
+            reference = '?'
+        shape.append('%s:%s:%s' % (param, ' '.join(names), reference))
+    return ','.join(shape)
+
+
+def spec_cache_key(func, options=()):
+    '''Return a hex digest identifying the code, name, docstring and default
+    types of func, and any options that affect its spec. Any change to those
+    invalidates cached specs.'''
+    import hashlib
+    code = func.__code__
+    parts = [
+        __version__, sys.version, func.__module__,
+        getattr(func, '__qualname__', func.__name__),
+        repr(code.co_code), repr(code.co_varnames), repr(code.co_argcount),
+        repr(code.co_flags), func.__doc__ or '',
+        _defaults_shape(func.__defaults__),
+        _annotations_shape(getattr(func, '__annotations__', None) or {}),
+        repr(options),
+    ]
+    return hashlib.sha1('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+def _load_spec(path):
+    try:
+        with open(path, 'rb') as spec_file:
+            return marshal.load(spec_file)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def _save_spec(path, spec):
+    '''Atomically write spec to path. Caching is best effort, so failures
+    are ignored.'''
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(tmp_path, 'wb') as spec_file:
+            marshal.dump(spec, spec_file)
+        getattr(os, 'replace', os.rename)(tmp_path, path)
+    except (IOError, OSError, ValueError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def _parse_config(path):
+    '''Parse the TOML, JSON or INI file at path into a dict.'''
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.json':
+        import json
+        with open(path) as config_file:
+            return json.load(config_file)
+    if extension == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            import tomli as tomllib
+        with open(path, 'rb') as config_file:
+            return tomllib.load(config_file)
+    try:
+        import configparser
+    except ImportError:
+        import ConfigParser as configparser
+    parser = configparser.RawConfigParser()
+    parser.read(path)
+    return dict((section, dict(parser.items(section)))
+                for section in parser.sections())
+
+
+def read_config(path, cache_dir=None):
+    '''Return the contents of the config file at path as a dict, or None if
+    it doesn't exist. If cache_dir is given, the parsed contents are stored
+    there with marshal and reused until the file's mtime or size changes.'''
+    path = os.path.abspath(os.path.expanduser(path))
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    stamp = (getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size)
+    if cache_dir is not None:
+        import hashlib
+        key = hashlib.sha1(('%s\0%s' % (__version__, path)).encode(
+            'utf-8', 'surrogateescape')).hexdigest()
+        cache_path = os.path.join(cache_dir, key + '.config')
+        cached = _load_spec(cache_path)
+        if (isinstance(cached, tuple) and len(cached) == 2 and
+                cached[0] == stamp):
+            return cached[1]
+    data = _parse_config(path)
+    if cache_dir is not None:
+        _save_spec(cache_path, (stamp, data))
+    return data
+
+
+TRUE_STRINGS = ('1', 'true', 'yes', 'on')
+FALSE_STRINGS = ('0', 'false', 'no', 'off')
+
+
+def setting_value(param, value):
+    '''Convert a value for param's option from a config file or the
+    environment. Raises ValueError with a message if it isn't valid.'''
+    if param.action in ('store_true', 'store_false'):
+        if isinstance(value, bool):
+            return value
+        text = str(value).strip().lower()
+        if text in TRUE_STRINGS:
+            return True
+        if text in FALSE_STRINGS:
+            return False
+        raise ValueError('invalid boolean value: %r' % (value,))
+    if param.action == 'append':
+        if isinstance(value, str):
+            value = [item.strip() for item in value.split(',')]
+            value = [item for item in value if item]
+        elif not isinstance(value, list):
+            value = [value]
+        return [_setting_item(param, item) for item in value]
+    return _setting_item(param, value)
+
+
+def _setting_item(param, value):
+    if param.type is not None:
+        try:
+            value = param.type(value)
+        except (TypeError, ValueError):
+            raise ValueError('invalid %s value: %r' % (
+                getattr(param.type, '__name__', repr(param.type)), value))
+    if param.choices is not None and value not in param.choices:
+        raise ValueError('invalid choice: %r (choose from %s)' % (
+            value, ', '.join(repr(choice) for choice in param.choices)))
+    return value
+
+
+GOOGLE_PARAM_SECTIONS = frozenset([
+    'Args:', 'Arguments:', 'Parameters:', 'Params:', 'Keyword Args:',
+    'Keyword Arguments:', 'Other Parameters:'])
+GOOGLE_SECTIONS = GOOGLE_PARAM_SECTIONS | frozenset([
+    'Attributes:', 'Example:', 'Examples:', 'Note:', 'Notes:', 'Raises:',
+    'References:', 'Return:', 'Returns:', 'See Also:', 'Todo:', 'Warning:',
+    'Warnings:', 'Yield:', 'Yields:'])
+NUMPY_PARAM_SECTIONS = frozenset([
+    'Parameters', 'Other Parameters', 'Keyword Arguments'])
+NUMPY_SECTIONS = NUMPY_PARAM_SECTIONS | frozenset([
+    'Attributes', 'Examples', 'Methods', 'Notes', 'Raises', 'Receives',
+    'References', 'Returns', 'See Also', 'Warns', 'Warnings', 'Yields'])
+
+_docstrings = {}
+
+
+def parse_docstring(doc):
+    '''Split a docstring into its description and a dict mapping parameter
+    names to the tuple of words documenting them; the words start with any
+    option strings. Parameters may be documented with ReST :param name: fields
+    (anywhere in the text), or in a Google style Args: section or a NumPy
+    style Parameters section. Results are memoized per docstring.'''
+    try:
+        return _docstrings[doc]
+    except KeyError:
+        pass
+    result = _docstrings[doc] = _parse_docstring(doc or '')
+    return result
+
+
+def _parse_docstring(doc):
+    description = []
+    params = {}
+    current = []
+    mode = 'description'
+    section_indent = entry_indent = 0
+    # Lines such as "Note:" are only Google section headers in docstrings
+    # without ReST fields, or if an indented block follows them. Sections
+    # that don't document parameters only end the description in docstrings
+    # that have a parameter section; otherwise they are part of it.
+    rest_fields = ':param' in doc
+    lines = doc.expandtabs().splitlines()
+    structured = any(line.strip() in GOOGLE_PARAM_SECTIONS or
+                     line.strip() in NUMPY_PARAM_SECTIONS for line in lines)
+    index = 0
+    while index < len(lines):
+        line = lines[index]
+        index += 1
+        stripped = line.strip()
+        indent = len(line) - len(line.lstrip())
+
+        position = line.find(':param')
+        if position >= 0:
+            before = line[:position]
+            if mode == 'description':
+                description.append(before)
             else:
-                option_kwargs['action'] = 'append'
+                current.extend(before.split())
+            while position >= 0:
+                end = line.find(':', position + 6)
+                if end < 0:
+                    end = len(line)
+                field = line[position + 6:end].split()
+                current = params.setdefault(field[-1] if field else '', [])
+                position = line.find(':param', end)
+                text = line[end + 1:position if position >= 0 else None]
+                current.extend(text.split())
+            mode = 'rest'
+            continue
 
-        parser.add_argument(*names, **option_kwargs)
-    if varargs:
-        parser.add_argument(varargs, nargs='*')
+        if stripped in NUMPY_SECTIONS and index < len(lines) and \
+                lines[index].strip() and \
+                not lines[index].strip().strip('-') and \
+                (structured or mode != 'description' or
+                 stripped in NUMPY_PARAM_SECTIONS):
+            mode = 'numpy' if stripped in NUMPY_PARAM_SECTIONS else 'other'
+            section_indent = indent
+            index += 1
+            continue
+        if stripped in GOOGLE_SECTIONS and (
+                structured or mode != 'description' or
+                stripped in GOOGLE_PARAM_SECTIONS) and (
+                not rest_fields or (
+                    index < len(lines) and lines[index].strip() and
+                    len(lines[index]) - len(lines[index].lstrip()) > indent)):
+            if stripped in GOOGLE_PARAM_SECTIONS:
+                mode = 'google'
+            else:
+                mode = 'other'
+            section_indent = indent
+            entry_indent = None
+            continue
+
+        if mode == 'description':
+            description.append(line)
+        elif mode == 'rest':
+            current.extend(line.split())
+        elif not stripped or mode == 'other':
+            continue
+        elif indent <= section_indent and mode == 'google':
+            mode = 'other'
+        elif mode == 'google':
+            if entry_indent is None:
+                entry_indent = indent
+            if indent <= entry_indent and ':' in stripped:
+                field, text = stripped.split(':', 1)
+                name = field.split('(')[0].strip().lstrip('*')
+                current = params.setdefault(name, [])
+                current.extend(text.split())
+            else:
+                current.extend(stripped.split())
+        elif indent <= section_indent:
+            current = []
+            for name in stripped.split(':')[0].split(','):
+                params[name.strip().lstrip('*')] = current
+        else:
+            current.extend(stripped.split())
+    params = dict((name, tuple(words)) for name, words in params.items())
+    return '\n'.join(description).strip(), params
+
+
+def phase_tracer(destination, command_name):
+    '''Return an on_phase callback that writes each timing as a line of JSON
+    to destination: '1' for stderr, or the name of a file to append to. The
+    file is opened for each line, so no handle is held between phases, and
+    lines that can't be written are dropped.'''
+    import json
+
+    def on_phase(phase, elapsed_ns):
+        line = json.dumps({
+            'command': command_name,
+            'phase': phase,
+            'elapsed_ns': elapsed_ns,
+        }) + '\n'
+        if destination == '1':
+            sys.stderr.write(line)
+            sys.stderr.flush()
+            return
+        try:
+            with open(destination, 'a') as stream:
+                stream.write(line)
+        except (IOError, OSError):
+            pass
+    return on_phase
+
+
+def record_usage():
+    '''Start measuring resource usage. Returns a function that returns a
+    dict of what was used since: 'time' (the start, in seconds since the
+    epoch), 'wall_ns', and where the resource module is available,
+    'cpu_ns' (user and system time) and 'max_rss_kb' (the peak resident
+    set size of the process so far).'''
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    start_time = time.time()
+    if resource is not None:
+        before = resource.getrusage(resource.RUSAGE_SELF)
+    start = _clock_ns()
+
+    def usage():
+        record = {'time': start_time, 'wall_ns': _clock_ns() - start}
+        if resource is not None:
+            after = resource.getrusage(resource.RUSAGE_SELF)
+            record['cpu_ns'] = int(1e9 * (
+                after.ru_utime - before.ru_utime +
+                after.ru_stime - before.ru_stime))
+            max_rss = after.ru_maxrss
+            if sys.platform == 'darwin':
+                max_rss //= 1024
+            record['max_rss_kb'] = max_rss
+        return record
+    return usage
+
+
+def _is_default(value, default):
+    if value is default:
+        return True
+    if type(value) is type(default):
+        return value == default
+    # Vectorized options turn an empty default list into an empty array.
+    return default == [] and hasattr(value, '__len__') and not len(value)
+
+
+# The most telemetry records held in memory waiting to be written; more are
+# dropped rather than making the command wait.
+TELEMETRY_BUFFER = 10000
+
+
+class TelemetryWriter(object):
+    '''Writes records as JSON lines to destination from a background thread,
+    so callers never wait for I/O. destination is a file name to append to
+    or unix:PATH to send each line as a datagram to a Unix socket. Records
+    that can't be written are dropped. Queued records are written when the
+    interpreter exits, or by flush().'''
+    def __init__(self, destination):
+        import atexit
+        import threading
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue
+        self.destination = destination
+        self.pid = os.getpid()
+        self._queue = queue.Queue(TELEMETRY_BUFFER)
+        self._full = queue.Full
+        self._thread = threading.Thread(
+            target=self._run, name='opterator-telemetry')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def write(self, record):
+        '''Queue record, a dict, to be written.'''
+        try:
+            self._queue.put_nowait(record)
+        except self._full:
+            pass
+
+    def flush(self, timeout=1.0):
+        '''Wait up to timeout seconds for the queued records to be
+        written.'''
+        import threading
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except self._full:
+            return
+        done.wait(timeout)
+
+    def _run(self):
+        import json
+        sink = None
+        while True:
+            items = [self._queue.get()]
+            while not self._queue.empty():
+                items.append(self._queue.get_nowait())
+            lines = []
+            for item in items:
+                if isinstance(item, dict):
+                    lines.append(json.dumps(item, sort_keys=True) + '\n')
+            try:
+                if lines:
+                    if sink is None:
+                        sink = self._open()
+                    self._send(sink, lines)
+            except (IOError, OSError):
+                sink = None
+            for item in items:
+                if not isinstance(item, dict):
+                    item.set()
+
+    def _open(self):
+        if self.destination.startswith('unix:'):
+            import socket
+            sink = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sink.setblocking(False)
+            sink.connect(self.destination[len('unix:'):])
+            return sink
+        return open(self.destination, 'a')
+
+    def _send(self, sink, lines):
+        if hasattr(sink, 'sendall'):
+            for line in lines:
+                sink.send(line.encode('utf-8'))
+        else:
+            sink.write(''.join(lines))
+            sink.flush()
+
+
+_telemetry_writers = {}
+
+
+def telemetry_writer(destination):
+    '''Return the TelemetryWriter for destination in this process.'''
+    writer = _telemetry_writers.get(destination)
+    # A forked child inherits the writer but not its thread.
+    if writer is None or writer.pid != os.getpid():
+        writer = _telemetry_writers[destination] = TelemetryWriter(
+            destination)
+    return writer
+
+
+def flush_telemetry():
+    '''Write out the telemetry records queued by this process.'''
+    for writer in list(_telemetry_writers.values()):
+        if writer.pid == os.getpid():
+            writer.flush()
 
-    def wrapper(argv=None):
-        args = vars(parser.parse_args(argv))
-        processed_args = [args[p] for p in positional_params + kw_params]
+
+def _evict(directory, suffix, max_size):
+    '''Remove the least recently used files ending with suffix from
+    directory until they take up at most max_size bytes.'''
+    entries = []
+    total = 0
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        if not name.endswith(suffix):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, path, stat.st_size))
+        total += stat.st_size
+    entries.sort()
+    for mtime, path, size in entries:
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def _combine_callbacks(first, second):
+    if first is None:
+        return second
+    if second is None:
+        return first
+
+    def combined(*args):
+        first(*args)
+        second(*args)
+    return combined
+
+
+class ParamSpec(object):
+    '''One parameter of a command. kind is 'positional', 'option' or
+    'varargs'; position is its index in the function's signature. Options
+    also have option strings (names), an ArgumentParser action, a default
+    value and possibly choices. type is the callable that converts values
+    from strings, or None to keep them as strings.'''
+    __slots__ = ('name', 'position', 'kind', 'names', 'action', 'help',
+                 'default', 'choices', 'type')
+
+    def __init__(self, name, position, kind, names=(), action='store',
+                 help='', default=None, type=None):
+        self.name = name
+        self.position = position
+        self.kind = kind
+        self.names = tuple(names)
+        self.action = action
+        self.help = help
+        self.default = default
+        self.type = type
+        self.choices = None
+        if (action == 'store' and isinstance(default, (list, tuple)) and
+                default):
+            self.choices = default
+
+    def __repr__(self):
+        return 'ParamSpec(%r, %r, %r)' % (self.name, self.position, self.kind)
+
+    def add_to(self, parser, convert=True):
+        '''Add this parameter to an ArgumentParser. If convert is False,
+        values are left as strings even if the parameter has a type.'''
+        extra = {}
+        if convert and self.type is not None:
+            extra['type'] = self.type
+        if self.kind == 'positional':
+            parser.add_argument(self.name, help=self.help, **extra)
+        elif self.kind == 'varargs':
+            parser.add_argument(self.name, nargs='*', **extra)
+        else:
+            option_kwargs = {
+                'action': self.action,
+                'help': self.help,
+                'dest': self.name,
+                'default': self.default
+            }
+            if self.choices is not None:
+                option_kwargs['choices'] = self.choices
+            option_kwargs.update(extra)
+            parser.add_argument(*self.names, **option_kwargs)
+
+    def convert_error(self, value):
+        '''Return the message ArgumentParser reports when value can't be
+        converted with this parameter's type.'''
+        return 'argument %s: invalid %s value: %r' % (
+            '/'.join(self.names) or self.name,
+            getattr(self.type, '__name__', repr(self.type)), value)
+
+
+NUMERIC_TYPES = (int, float)
+
+
+def _infer_type(default):
+    '''Return the type to convert option values with, given the default.'''
+    if type(default) in (list, tuple) and default:
+        default = default[0]
+    if type(default) in NUMERIC_TYPES:
+        return type(default)
+    if type(default).__module__ == 'pathlib':
+        return type(default)
+    return None
+
+
+# Callable, but converting a string with them splits it into characters.
+COLLECTION_TYPES = (list, tuple, set, frozenset, dict)
+
+
+def _is_converter(annotation):
+    '''Return whether an annotation can convert option values: a class or
+    other callable, but not a collection type or a typing construct such as
+    Optional[int] or list[int].'''
+    if isinstance(annotation, str) or not callable(annotation):
+        return False
+    if any(annotation is collection for collection in COLLECTION_TYPES):
+        return False
+    return (getattr(annotation, '__module__', None) != 'typing' and
+            getattr(annotation, '__origin__', None) is None)
+
+
+def _annotation_parts(annotation):
+    '''Split an annotation into (option_strings, type). An annotation may be
+    a list of option strings, a type (see _is_converter), or a list of
+    option strings that also contains a type. Other annotations are
+    ignored.'''
+    if isinstance(annotation, (list, tuple)):
+        names = [part for part in annotation if isinstance(part, str)]
+        types = [part for part in annotation if _is_converter(part)]
+        return names, types[0] if types else None
+    if _is_converter(annotation):
+        return [], annotation
+    return [], None
+
+
+def _type_reference(converter):
+    '''Return a module:qualname string that _resolve_type can import, or
+    raise ValueError if converter can't be referenced that way.'''
+    if converter is None:
+        return None
+    name = getattr(converter, '__qualname__', getattr(
+        converter, '__name__', ''))
+    module = getattr(converter, '__module__', None)
+    if not module or not name or '<' in name:
+        raise ValueError('cannot reference %r' % (converter,))
+    return '%s:%s' % (module, name)
+
+
+def _resolve_type(reference):
+    if reference is None:
+        return None
+    import importlib
+    module_name, name = reference.split(':')
+    obj = importlib.import_module(module_name)
+    for attribute in name.split('.'):
+        obj = getattr(obj, attribute)
+    return obj
+
+
+def _option_action(default):
+    if default is False:
+        return 'store_true'
+    elif default is True:
+        return 'store_false'
+    elif type(default) in (list, tuple) and not default:
+        return 'append'
+    return 'store'
+
+
+class CommandSpec(object):
+    '''The compiled description of an opterate decorated function: its
+    description and ParamSpecs for the positional parameters, the options
+    and varargs (None if there are none), in signature order. Build one with
+    CommandSpec.from_function; no parser is needed to inspect it.'''
+    __slots__ = ('name', 'description', 'params', 'positional', 'options',
+                 'varargs', 'dests', '_getter')
+
+    def __init__(self, name, description, params):
+        import operator
+        self.name = name
+        self.description = description
+        self.params = tuple(params)
+        self.positional = tuple(
+            p for p in self.params if p.kind == 'positional')
+        self.options = tuple(p for p in self.params if p.kind == 'option')
+        varargs = [p for p in self.params if p.kind == 'varargs']
+        self.varargs = varargs[0] if varargs else None
+        self.dests = tuple(p.name for p in self.positional + self.options)
+        if len(self.dests) == 1:
+            getter = operator.itemgetter(self.dests[0])
+            self._getter = lambda values: (getter(values),)
+        elif self.dests:
+            self._getter = operator.itemgetter(*self.dests)
+        else:
+            self._getter = lambda values: ()
+
+    def __repr__(self):
+        return 'CommandSpec(%r, %r)' % (self.name, self.params)
+
+    @classmethod
+    def from_function(cls, func, on_phase=None, short_option_fallback=False,
+                      reserved=()):
+        '''Introspect func. on_phase is called with the time taken by the
+        'argspec', 'docstring' and 'options' phases (see opterate).
+        short_option_fallback and reserved are passed to allocate_options.'''
+        if on_phase is not None:
+            start = _clock_ns()
+        (
+            positional_params, kw_params, varargs, defaults, annotations
+        ) = portable_argspec(func)
+        if on_phase is not None:
+            on_phase('argspec', _clock_ns() - start)
+            start = _clock_ns()
+
+        description, param_docs = parse_docstring(func.__doc__)
+        if on_phase is not None:
+            on_phase('docstring', _clock_ns() - start)
+            start = _clock_ns()
+
+        types = {}
+        option_names = {}
+        for param, annotation in annotations.items():
+            option_names[param], types[param] = _annotation_parts(annotation)
+
+        params = [
+            ParamSpec(param, position, 'positional',
+                      help=' '.join(param_docs.get(param, ())),
+                      type=types.get(param))
+            for position, param in enumerate(positional_params)]
+        explicit = {}
+        option_help = {}
+        for param in kw_params:
+            names = list(option_names.get(param, ()))
+            param_doc = []
+            if param in param_docs:
+                param_doc = list(param_docs[param])
+                while param_doc and param_doc[0].startswith('-'):
+                    names.append(param_doc.pop(0))
+            if names:
+                explicit[param] = names
+            option_help[param] = ' '.join(param_doc)
+        allocated = allocate_options(
+            kw_params, explicit, short_option_fallback, reserved)
+
+        for param, default in zip(kw_params, defaults or ()):
+            action = _option_action(default)
+            converter = types.get(param)
+            if action in ('store_true', 'store_false'):
+                # Flags take no value to convert.
+                converter = None
+            elif converter is None:
+                converter = _infer_type(default)
+            params.append(ParamSpec(
+                param, len(params), 'option', allocated[param], action,
+                option_help[param], default, converter))
         if varargs:
-            processed_args.extend(args[varargs])
-        func(*processed_args)
-    return wrapper
+            params.append(ParamSpec(
+                varargs, len(params), 'varargs', type=types.get(varargs)))
+        if on_phase is not None:
+            on_phase('options', _clock_ns() - start)
+        return cls(func.__name__, description, params)
+
+    def to_data(self):
+        '''Return the spec as plain data that marshal can serialize. Default
+        values are left out; from_data takes them from the function. Raises
+        ValueError if a parameter's type can't be referenced by name.'''
+        return (self.name, self.description, tuple(
+            (p.name, p.kind, p.names, p.action, p.help,
+             _type_reference(p.type))
+            for p in self.params))
+
+    @classmethod
+    def from_data(cls, data, func):
+        '''Rebuild a spec serialized with to_data for func.'''
+        name, description, param_data = data
+        options = [d[0] for d in param_data if d[1] == 'option']
+        defaults = dict(zip(options, func.__defaults__ or ()))
+        params = [
+            ParamSpec(param, position, kind, names, action, help_text,
+                      defaults.get(param), _resolve_type(reference))
+            for position, (param, kind, names, action, help_text, reference)
+            in enumerate(param_data)]
+        return cls(name, description, params)
+
+    def arguments(self, values):
+        '''Return the tuple of positional arguments to call the function
+        with, given a dict of parsed values keyed by parameter name.'''
+        if self.varargs is None:
+            return self._getter(values)
+        return self._getter(values) + tuple(values[self.varargs.name])
+
+
+class ParseError(Exception):
+    '''Raised when a command line can't be parsed or asks for help. output is
+    the text ArgumentParser would have printed to stream ('stdout' or
+    'stderr') and status is the exit status it would have used.'''
+    def __init__(self, message, status=2, output='', stream='stderr'):
+        Exception.__init__(self, message)
+        self.message = message
+        self.status = status
+        self.output = output
+        self.stream = stream
+
+    def __reduce__(self):
+        return (ParseError,
+                (self.message, self.status, self.output, self.stream))
+
+    def exit(self):
+        '''Write the output to the stream it is meant for and exit with the
+        status, as ArgumentParser would have.'''
+        stream = sys.stdout if self.stream == 'stdout' else sys.stderr
+        stream.write(self.output)
+        sys.exit(self.status)
+
+
+_parser_class = None
+
+
+def _terminal_columns():
+    '''Return the terminal width ArgumentParser wraps help text to.'''
+    try:
+        from shutil import get_terminal_size
+    except ImportError:  # PYTHON 2 MUST DIE
+        # Python 2's argparse only looks at $COLUMNS.
+        try:
+            return int(os.environ['COLUMNS'])
+        except (KeyError, ValueError):
+            return 80
+    return get_terminal_size().columns
+
+
+def argument_parser_class():
+    '''Return an ArgumentParser subclass that raises ParseError instead of
+    writing help or errors to stdout and stderr and exiting. The class (and
+    argparse) is only loaded when first needed.'''
+    global _parser_class
+    if _parser_class is None:
+        import argparse
+
+        class OpteratorArgumentParser(argparse.ArgumentParser):
+            def print_help(self, file=None):
+                if file is not None:
+                    return argparse.ArgumentParser.print_help(self, file)
+                raise ParseError(
+                    'help requested', 0, self.format_help(), 'stdout')
+
+            def error(self, message):
+                output = self.format_usage() + argparse._(
+                    '%(prog)s: error: %(message)s\n') % {
+                        'prog': self.prog, 'message': message}
+                raise ParseError(message, 2, output)
+
+            def exit(self, status=0, message=None):
+                raise ParseError(message or '', status, message or '')
+
+        _parser_class = OpteratorArgumentParser
+    return _parser_class
+
+
+class RunResult(object):
+    '''The outcome of one invocation from Command.run_many: value is the
+    return value of the decorated function, or error is the ParseError
+    raised for argv. status is the exit status the invocation would have
+    had: 0 if the function returned, the ParseError's status, or the code
+    of a SystemExit raised by the function.'''
+    __slots__ = ('argv', 'value', 'error', 'status')
+
+    def __init__(self, argv, value=None, error=None, status=0):
+        self.argv = argv
+        self.value = value
+        self.error = error
+        self.status = status
+
+    def __getstate__(self):
+        return (self.argv, self.value, self.error, self.status)
+
+    def __setstate__(self, state):
+        self.argv, self.value, self.error, self.status = state
+
+    def __repr__(self):
+        return 'RunResult(%r, value=%r, error=%r, status=%r)' % (
+            self.argv, self.value, self.error, self.status)
+
+
+# Commands that can't be pickled, by id, for worker processes forked while
+# they run batches.
+_forked_commands = {}
+
+
+def _worker_command(command):
+    if isinstance(command, Command):
+        return command
+    return _forked_commands[command]
+
+
+def _run_in_worker(command, argv):
+    return _worker_command(command)._run_one(argv)
+
+
+def _call_item_in_worker(command, arguments, capture):
+    return _worker_command(command)._call_item(arguments, capture)
+
+
+# Option strings and destination of the option added by parallel='varargs'.
+JOBS_OPTIONS = ('-j', '--jobs')
+JOBS_DEST = 'opterator_jobs'
+
+# Hidden options added by diagnostics=True, and the number of lines of the
+# allocation report written for --opterator-tracemalloc. They are prefixed
+# so they don't take the option strings of parameters such as profile.
+PROFILE_OPTION = '--opterator-profile'
+PROFILE_DEST = 'opterator_profile'
+TRACEMALLOC_OPTION = '--opterator-tracemalloc'
+TRACEMALLOC_DEST = 'opterator_tracemalloc'
+TRACEMALLOC_TOP = 25
+
+# The stack of output captures of each thread (see _start_capture), and
+# the number of captures in progress in the process.
+_captures = None
+_capturing = 0
+_capture_lock = _thread.allocate_lock()
+
+
+def _start_capture(tee):
+    '''Start capturing what the current thread writes to sys.stdout and
+    sys.stderr, and return the pair of StringIO buffers it goes to. If tee
+    is true the text is also written where it would have gone otherwise.
+    Other threads' output is unaffected. Pass the buffers to _stop_capture
+    when done.'''
+    global _captures, _capturing
+    import io
+    import threading
+    with _capture_lock:
+        if _captures is None:
+            _captures = threading.local()
+        if not isinstance(sys.stdout, _StreamRouter):
+            sys.stdout = _StreamRouter(sys.stdout, 0)
+        if not isinstance(sys.stderr, _StreamRouter):
+            sys.stderr = _StreamRouter(sys.stderr, 1)
+        _capturing += 1
+    buffers = (io.StringIO(), io.StringIO())
+    stack = getattr(_captures, 'stack', None)
+    if stack is None:
+        stack = _captures.stack = []
+    stack.append((buffers, tee))
+    return buffers
+
+
+def _stop_capture(buffers):
+    '''End the capture started by _start_capture that returned buffers.
+    sys.stdout and sys.stderr are restored once no thread is capturing.'''
+    global _capturing
+    stack = _captures.stack
+    for index in range(len(stack) - 1, -1, -1):
+        if stack[index][0] is buffers:
+            del stack[index]
+            break
+    with _capture_lock:
+        _capturing -= 1
+        if not _capturing:
+            if isinstance(sys.stdout, _StreamRouter):
+                sys.stdout = sys.stdout._stream
+            if isinstance(sys.stderr, _StreamRouter):
+                sys.stderr = sys.stderr._stream
+
+
+class _StreamRouter(object):
+    '''Stands in for sys.stdout (index 0) or sys.stderr (index 1) while
+    output is being captured, sending each thread's writes to the buffers
+    of its captures.'''
+    def __init__(self, stream, index):
+        self._stream = stream
+        self._index = index
+
+    def write(self, text):
+        stack = getattr(_captures, 'stack', None) or ()
+        depth = len(stack)
+        while depth:
+            depth -= 1
+            buffers, tee = stack[depth]
+            buffers[self._index].write(text)
+            if not tee:
+                return len(text)
+        return self._stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def _write_allocation_report(path, snapshot, peak):
+    '''Write the lines of a tracemalloc snapshot that allocated the most
+    memory to path.'''
+    import tracemalloc
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<unknown>')])
+    stats = snapshot.statistics('lineno')
+    with open(path, 'w') as report:
+        report.write('Peak traced memory: %.1f KiB\n' % (peak / 1024.0))
+        report.write('Still allocated: %.1f KiB in %d blocks\n' % (
+            sum(stat.size for stat in stats) / 1024.0,
+            sum(stat.count for stat in stats)))
+        report.write('Top %d lines:\n' % TRACEMALLOC_TOP)
+        for stat in stats[:TRACEMALLOC_TOP]:
+            report.write('%s\n' % (stat,))
+
+
+def exit_status(code):
+    '''Return the process exit status for a SystemExit code, printing it to
+    stderr the way the interpreter does if it isn't an integer.'''
+    if code is not None and not isinstance(code, int):
+        sys.stderr.write('%s\n' % (code,))
+    return _exit_code(code)
+
+
+def _exit_code(code):
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    return 1
+
+
+def _encode_request(argv, cwd, environ):
+    fields = [cwd, str(len(argv))] + list(argv)
+    fields.extend('%s=%s' % item for item in environ.items())
+    return b'\0'.join(os.fsencode(field) for field in fields)
+
+
+def _decode_request(data):
+    fields = [os.fsdecode(field) for field in data.split(b'\0')]
+    cwd = fields[0]
+    argc = int(fields[1])
+    argv = fields[2:argc + 2]
+    environ = dict(field.split('=', 1) for field in fields[argc + 2:])
+    return argv, cwd, environ
+
+
+def run_client(path, argv=None, fds=(0, 1, 2)):
+    '''Ask the server listening on the Unix socket at path (see
+    Command.serve) to run its command with argv, defaulting to sys.argv.
+    argv[0] is used as the program name unless it is empty. The
+    current directory, environment and the file descriptors in fds (stdin,
+    stdout and stderr) are passed along. Returns the exit status.'''
+    import array
+    import socket
+    if argv is None:
+        argv = sys.argv
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+        data = _encode_request(argv, os.getcwd(), os.environ)
+        ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                      array.array('i', fds).tobytes())]
+        sent = client.sendmsg([data], ancillary)
+        if sent < len(data):
+            client.sendall(data[sent:])
+        client.shutdown(socket.SHUT_WR)
+        status = b''
+        while True:
+            chunk = client.recv(64)
+            if not chunk:
+                break
+            status += chunk
+    finally:
+        client.close()
+    return int(status) if status else 1
+
+
+class _NotHandled(Exception):
+    '''Raised by fast_parse when a command line needs ArgumentParser.'''
+
+
+def fast_parse(table, argv, settings=None):
+    '''Parse argv in a single pass using a table built by fast_parse_table.
+    Returns a dict mapping destinations to values, starting from the
+    table's defaults updated with settings. Raises _NotHandled for anything
+    it does not support (help, abbreviated or combined options, invalid
+    input, ...); ArgumentParser should be used in that case.'''
+    options, positional, varargs, defaults = table
+    values = dict(defaults)
+    if settings:
+        values.update(settings)
+    required = len(positional)
+    filled = 0
+    extra = []
+    in_chunk = False
+    index = 0
+    count = len(argv)
+    while index < count:
+        arg = argv[index]
+        index += 1
+        if arg[:1] != '-' or arg == '-':
+            if not in_chunk:
+                in_chunk = True
+                # argparse consumes varargs along with the chunk of
+                # positional arguments that satisfies the required ones, so
+                # it rejects any later chunk.
+                if varargs and filled == required and (filled or extra):
+                    raise _NotHandled(arg)
+            if filled < required:
+                dest, converter = positional[filled]
+                values[dest] = _fast_convert(converter, arg)
+                filled += 1
+            elif varargs:
+                extra.append(_fast_convert(varargs[1], arg))
+            else:
+                raise _NotHandled(arg)
+            continue
+        in_chunk = False
+        value = None
+        if arg[:2] == '--' and '=' in arg:
+            arg, value = arg.split('=', 1)
+        try:
+            dest, action, choices, converter = options[arg]
+        except KeyError:
+            raise _NotHandled(arg)
+        if action == 'store_true' or action == 'store_false':
+            if value is not None:
+                raise _NotHandled(arg)
+            values[dest] = action == 'store_true'
+            continue
+        if value is None:
+            if index == count or argv[index][:1] == '-':
+                raise _NotHandled(arg)
+            value = argv[index]
+            index += 1
+        value = _fast_convert(converter, value)
+        if choices is not None and value not in choices:
+            raise _NotHandled(arg)
+        if action == 'append':
+            items = values[dest]
+            if items is None:
+                items = []
+            elif type(items) is not list:
+                raise _NotHandled(arg)
+            values[dest] = items + [value]
+        else:
+            values[dest] = value
+    if filled < required:
+        raise _NotHandled(None)
+    if varargs:
+        values[varargs[0]] = extra
+    return values
+
+
+def _fast_convert(converter, value):
+    if converter is None:
+        return value
+    try:
+        return converter(value)
+    except Exception:
+        raise _NotHandled(value)
+
+
+def fast_parse_table(spec, raw=()):
+    '''Build the lookup table used by fast_parse from a CommandSpec. Values
+    of the parameters named in raw are left as strings. Returns None if the
+    command can't be parsed by fast_parse.'''
+    options = {}
+    defaults = {}
+    for param in spec.options:
+        converter = None if param.name in raw else param.type
+        default = param.default
+        if converter is not None and isinstance(default, str):
+            # ArgumentParser converts string defaults too.
+            try:
+                default = converter(default)
+            except Exception:
+                return None
+        defaults[param.name] = default
+        for name in param.names:
+            options[name] = (
+                param.name, param.action, param.choices, converter)
+    positional = tuple((param.name, param.type) for param in spec.positional)
+    varargs = None
+    if spec.varargs:
+        converter = None
+        if spec.varargs.name not in raw:
+            converter = spec.varargs.type
+        varargs = (spec.varargs.name, converter)
+    return options, positional, varargs, defaults
+
+
+# Response files at least this large are memory-mapped rather than read.
+MMAP_THRESHOLD = 1 << 20
+
+
+def _file_lines(path):
+    '''Yield the lines of the file at path as bytes, without line endings.'''
+    with open(path, 'rb') as handle:
+        size = os.fstat(handle.fileno()).st_size
+        if size < MMAP_THRESHOLD:
+            for line in handle:
+                yield line.rstrip(b'\r\n')
+            return
+        import mmap
+        mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = 0
+            while start < size:
+                end = mapped.find(b'\n', start)
+                if end < 0:
+                    end = size
+                yield mapped[start:end].rstrip(b'\r')
+                start = end + 1
+        finally:
+            mapped.close()
+
+
+def iter_arguments(args, converter=None, stdin=None):
+    '''Lazily expand a list of command line arguments. Each argument of the
+    form @path is replaced by the lines of that file and - by the lines of
+    stdin (sys.stdin by default); blank lines are skipped. Files are read
+    as they are reached, and large ones are memory-mapped. Use ./@name for
+    a file whose name starts with @. converter is applied to each value.'''
+    encoding = sys.getfilesystemencoding()
+    for arg in args:
+        if arg == '-':
+            lines = (line.rstrip('\r\n') for line in stdin or sys.stdin)
+        elif arg[:1] == '@':
+            lines = (line.decode(encoding, 'surrogateescape')
+                     for line in _file_lines(arg[1:]))
+        else:
+            lines = (arg,)
+        for line in lines:
+            if line:
+                yield line if converter is None else converter(line)
+
+
+# Held while a Command's spec or parser is built, so that concurrent first
+# calls build them once. Later calls never take it. It is reentrant because
+# building a spec may import modules that build other commands.
+_build_lock = getattr(_thread, 'RLock', _thread.allocate_lock)()
+
+
+class Command(object):
+    '''The callable returned by opterate. Calling it with a list of arguments
+    (sys.argv[1:] by default) parses them and calls the decorated function.
+
+    The ArgumentParser is constructed lazily on first use so that importing a
+    module full of decorated entry points stays cheap.'''
+    def __init__(self, func, spec_cache=None, engine='argparse',
+                 on_phase=None, short_option_fallback=False, vectorize=False,
+                 stream_varargs=False, fast_loop=False, parallel=None,
+                 executor='thread', ordered_output=False, config=None,
+                 env_prefix=None, diagnostics=False, telemetry=None,
+                 cache=None, cache_files='mtime', cache_size=64 << 20):
+        if engine not in ('argparse', 'fast'):
+            raise ValueError('unknown engine %r' % (engine,))
+        if parallel not in (None, 'varargs'):
+            raise ValueError('unknown parallel mode %r' % (parallel,))
+        if executor not in ('thread', 'process'):
+            raise ValueError('unknown executor %r' % (executor,))
+        if vectorize not in (False, True, 'array', 'numpy'):
+            raise ValueError('unknown vectorize mode %r' % (vectorize,))
+        if cache_files not in ('mtime', 'hash'):
+            raise ValueError('unknown cache_files mode %r' % (cache_files,))
+        if cache and stream_varargs:
+            raise ValueError('streamed varargs cannot be cached')
+        trace = os.environ.get('OPTERATOR_TRACE')
+        if trace:
+            on_phase = _combine_callbacks(
+                on_phase, phase_tracer(trace, func.__name__))
+        self.func = func
+        self.__wrapped__ = func
+        self.__name__ = func.__name__
+        self.__module__ = func.__module__
+        self.__doc__ = func.__doc__
+        self.spec_cache = spec_cache
+        self.engine = engine
+        self.on_phase = on_phase
+        self.short_option_fallback = short_option_fallback
+        self.vectorize = vectorize
+        self.stream_varargs = stream_varargs
+        self.fast_loop = fast_loop
+        self.parallel = parallel
+        self.executor = executor
+        self.ordered_output = ordered_output
+        if isinstance(config, str):
+            config = [config]
+        self.config = tuple(config or ())
+        self.env_prefix = env_prefix
+        self.diagnostics = bool(
+            diagnostics or os.environ.get('OPTERATOR_DIAGNOSTICS'))
+        self.telemetry = telemetry or os.environ.get('OPTERATOR_TELEMETRY')
+        self.cache = cache
+        self.cache_files = cache_files
+        self.cache_size = cache_size
+        code = getattr(func, '__code__', None)
+        self.is_async = bool(code is not None and
+                             code.co_flags & CO_COROUTINE)
+        self._spec = None
+        self._parser = None
+        self._fast_table = False
+        self._vectorized = None
+        self._help = {}
+        self._call_table = None
+
+    def spec(self):
+        '''Return the CommandSpec for the decorated function, loading it from
+        the spec cache if one is configured.'''
+        if self._spec is None:
+            with _build_lock:
+                if self._spec is None:
+                    self._spec = self._make_spec()
+        return self._spec
+
+    def _make_spec(self):
+        on_phase = self.on_phase
+        reserved = self._reserved_options()
+        directory = cache_directory(self.spec_cache)
+        if directory is None:
+            spec = CommandSpec.from_function(
+                self.func, on_phase, self.short_option_fallback,
+                reserved)
+        else:
+            if on_phase is not None:
+                start = _clock_ns()
+            path = os.path.join(directory, self._cache_key() + '.spec')
+            data = _load_spec(path)
+            spec = None
+            if data is not None:
+                try:
+                    spec = CommandSpec.from_data(data, self.func)
+                except (TypeError, ValueError, ImportError,
+                        AttributeError):
+                    pass
+            if on_phase is not None:
+                on_phase('spec_cache', _clock_ns() - start)
+            if spec is None:
+                spec = CommandSpec.from_function(
+                    self.func, on_phase, self.short_option_fallback,
+                    reserved)
+                try:
+                    _save_spec(path, spec.to_data())
+                except ValueError:
+                    pass
+        if self.parallel and spec.varargs is None:
+            raise ValueError(
+                "parallel='varargs' needs a function with *varargs")
+        return spec
+
+    def _reserved_options(self):
+        return tuple(
+            name for names, dest, converter, default, metavar, help_text
+            in self._extra_options() for name in names)
+
+    def _extra_options(self):
+        '''Return (option_strings, dest, type, default, metavar, help)
+        tuples for the options the command adds for itself rather than for
+        a parameter. help is None for hidden options.'''
+        options = []
+        if self.parallel:
+            options.append((JOBS_OPTIONS, JOBS_DEST, int, 1, 'N',
+                            'process N items at once (0 for one per CPU)'))
+        if self.diagnostics:
+            options.append(((PROFILE_OPTION,), PROFILE_DEST, None, None,
+                            'PATH', None))
+            options.append(((TRACEMALLOC_OPTION,), TRACEMALLOC_DEST, None,
+                            None, 'PATH', None))
+        return options
+
+    def _cache_key(self, extra=()):
+        '''Return the spec_cache_key for the function and the options that
+        change its spec and parser, plus extra.'''
+        return spec_cache_key(self.func, (
+            self.short_option_fallback, self._reserved_options()) + extra)
+
+    def help_text(self):
+        '''Return the help ArgumentParser prints for -h, rendering it only
+        once for each program name and terminal width. If the spec cache is
+        enabled the text is stored there as well, so later processes can
+        print it without building the parser.'''
+        if self._parser is None:
+            # The parser will take its prog from sys.argv[0].
+            key = ('argv', sys.argv[0], _terminal_columns())
+        else:
+            key = ('prog', self._parser.prog, _terminal_columns())
+        text = self._help.get(key)
+        if text is None:
+            path = None
+            directory = cache_directory(self.spec_cache)
+            if directory is not None:
+                # The spec key only records the shape of the defaults, but
+                # the help lists the choices themselves.
+                choices = repr([default for default in
+                                self.func.__defaults__ or ()
+                                if type(default) in (list, tuple)])
+                path = os.path.join(
+                    directory, self._cache_key(key + (choices,)) + '.help')
+                text = _load_spec(path)
+            if not isinstance(text, str):
+                text = self.build().format_help()
+                if path is not None:
+                    _save_spec(path, text)
+            self._help[key] = text
+        return text
+
+    def build(self):
+        '''Build the ArgumentParser for the decorated function if it hasn't
+        been built yet, and return it. Call this to warm up a command eagerly
+        instead of paying for it on the first invocation.'''
+        if self._parser is None:
+            self.spec()
+            with _build_lock:
+                if self._parser is None:
+                    self._parser = self._build_parser()
+        return self._parser
+
+    def _build_parser(self):
+        spec = self.spec()
+        if self.on_phase is not None:
+            start = _clock_ns()
+        parser = argument_parser_class()(description=spec.description)
+        raw = self._raw_params()
+        for param in spec.params:
+            param.add_to(parser, convert=param not in raw)
+        for names, dest, converter, default, metavar, help_text in (
+                self._extra_options()):
+            if help_text is None:
+                import argparse
+                help_text = argparse.SUPPRESS
+            parser.add_argument(*names, type=converter, default=default,
+                                dest=dest, metavar=metavar, help=help_text)
+        if self.on_phase is not None:
+            self.on_phase('add_arguments', _clock_ns() - start)
+        return parser
+
+    def _parse(self, argv):
+        '''Parse argv and return a dict of destination: value pairs. Raises
+        ParseError rather than printing help or errors.'''
+        if argv is None:
+            argv = sys.argv[1:]
+        if len(argv) == 1 and argv[0] in HELP_OPTION[0]:
+            raise ParseError('help requested', 0, self.help_text(), 'stdout')
+        if self.on_phase is None:
+            return self._parse_args(argv)
+        self.spec()
+        if self.engine != 'fast':
+            self.build()
+        start = _clock_ns()
+        try:
+            return self._parse_args(argv)
+        finally:
+            self.on_phase('parse', _clock_ns() - start)
+
+    def _parse_args(self, argv):
+        values = None
+        settings = None
+        if self.config or self.env_prefix:
+            settings = self._settings()
+        if self.engine == 'fast':
+            if self._fast_table is False:
+                table = fast_parse_table(self.spec(), [
+                    param.name for param in self._raw_params()])
+                if table is not None:
+                    options, positional, varargs, defaults = table
+                    for names, dest, converter, default, metavar, help_text \
+                            in self._extra_options():
+                        for name in names:
+                            options[name] = (dest, 'store', None, converter)
+                        defaults[dest] = default
+                # Only publish the table once it is complete, as other
+                # threads may be parsing with it.
+                self._fast_table = table
+            if self._fast_table is not None:
+                try:
+                    values = fast_parse(self._fast_table, argv, settings)
+                except _NotHandled:
+                    pass
+        if values is None:
+            namespace = None
+            if settings:
+                import argparse
+                # ArgumentParser only fills in defaults for attributes the
+                # namespace doesn't already have.
+                namespace = argparse.Namespace(**settings)
+            values = vars(self.build().parse_args(argv, namespace))
+        if self.vectorize:
+            for param in self._vectorized_params():
+                if isinstance(values[param.name], list):
+                    values[param.name] = self._to_array(
+                        param, values[param.name])
+        varargs = self.spec().varargs
+        if self.stream_varargs and varargs is not None:
+            values[varargs.name] = [
+                self._stream(varargs, values[varargs.name])]
+        return values
+
+    def _settings(self):
+        '''Return a dict of the option values set by the config files and
+        environment variables, which override the function's defaults.'''
+        settings = {}
+        options = self.spec().options
+        if self.config:
+            directory = cache_directory(
+                True if self.spec_cache is None else self.spec_cache)
+            by_key = dict((param.name, param) for param in options)
+            by_key.update((param.name.replace('_', '-'), param)
+                          for param in options)
+            for path in self.config:
+                try:
+                    data = read_config(path, directory)
+                except Exception as error:
+                    self.build().error('config file %s: %s' % (path, error))
+                if data is None:
+                    continue
+                section = None
+                if isinstance(data, dict):
+                    section = data.get(self.__name__)
+                if not isinstance(section, dict):
+                    continue
+                for key, value in section.items():
+                    param = by_key.get(key)
+                    if param is None:
+                        self.build().error(
+                            'config file %s: unknown option %r' % (path, key))
+                    try:
+                        settings[param.name] = setting_value(param, value)
+                    except ValueError as error:
+                        self.build().error('config file %s: option %s: %s' % (
+                            path, key, error))
+        if self.env_prefix:
+            for param in options:
+                name = ('%s_%s' % (self.env_prefix, param.name)).upper()
+                value = os.environ.get(name)
+                if value is None:
+                    continue
+                try:
+                    settings[param.name] = setting_value(param, value)
+                except ValueError as error:
+                    self.build().error('environment variable %s: %s' % (
+                        name, error))
+        return settings
+
+    def _raw_params(self):
+        '''Return the ParamSpecs whose values the parser leaves as strings,
+        to be converted after parsing.'''
+        raw = self._vectorized_params()
+        varargs = self.spec().varargs
+        if self.stream_varargs and varargs is not None:
+            raw += (varargs,)
+        return raw
+
+    def _stream(self, param, args):
+        '''Return an iterator over the expanded varargs that reports
+        conversion errors and unreadable argument files as ArgumentParser
+        would.'''
+        values = self._expand(param, args)
+        if param.type is None:
+            return values
+        return (self._convert(param, value) for value in values)
+
+    def _expand(self, param, args):
+        values = iter_arguments(args)
+        while True:
+            try:
+                value = next(values)
+            except StopIteration:
+                return
+            except (IOError, OSError) as error:
+                self.build().error("argument %s: can't open '%s': %s" % (
+                    param.name, error.filename, error.strerror))
+            yield value
+
+    def _convert(self, param, value):
+        try:
+            return param.type(value)
+        except (TypeError, ValueError):
+            self.build().error(param.convert_error(value))
+
+    def _vectorized_params(self):
+        '''Return the ParamSpecs whose values are collected into arrays.'''
+        if self._vectorized is None:
+            self._vectorized = ()
+            if self.vectorize:
+                self._vectorized = tuple(
+                    param for param in self.spec().options
+                    if param.action == 'append' and
+                    param.type in NUMERIC_TYPES)
+        return self._vectorized
+
+    def _to_array(self, param, strings):
+        '''Convert a list of strings to an array of param's type, raising
+        ParseError as ArgumentParser would if one is invalid.'''
+        use_numpy = self.vectorize == 'numpy'
+        if self.vectorize is True:
+            try:
+                import numpy
+                use_numpy = True
+            except ImportError:
+                pass
+        try:
+            if use_numpy:
+                import numpy
+                dtype = numpy.int64 if param.type is int else numpy.float64
+                return numpy.asarray(strings, dtype=str).astype(dtype)
+            import array
+            typecode = 'q' if param.type is int else 'd'
+            return array.array(typecode, map(param.type, strings))
+        except (ValueError, OverflowError):
+            pass
+        for value in strings:
+            try:
+                param.type(value)
+            except ValueError:
+                break
+        self.build().error(param.convert_error(value))
+
+    def _call(self, args):
+        if self.cache and not (args.get(PROFILE_DEST) or
+                               args.get(TRACEMALLOC_DEST)):
+            return self._cached_call(args)
+        return self._call_function(args)
+
+    def _cached_call(self, args):
+        '''Replay the result of an earlier call with the same arguments and
+        files, or make the call and store its result.'''
+        directory = self.cache
+        if directory is True:
+            directory = os.path.join(cache_directory(True), 'results')
+        directory = os.path.expanduser(directory)
+        path = os.path.join(directory, self._result_key(args) + '.result')
+        entry = _load_spec(path)
+        if isinstance(entry, tuple) and len(entry) == 4:
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+            output, errors, exited, result = entry
+            sys.stdout.write(output)
+            sys.stderr.write(errors)
+            if exited:
+                raise SystemExit(result)
+            return result
+
+        # Only this thread's output is recorded, so concurrent calls each
+        # store their own.
+        buffers = _start_capture(True)
+        exited = False
+        try:
+            try:
+                result = self._call_function(args)
+            except SystemExit as error:
+                exited, result = True, error.code
+        finally:
+            _stop_capture(buffers)
+        # Results marshal can't store are skipped by _save_spec.
+        _save_spec(path, (buffers[0].getvalue(), buffers[1].getvalue(),
+                          exited, result))
+        _evict(directory, '.result', self.cache_size)
+        if exited:
+            raise SystemExit(result)
+        return result
+
+    def _result_key(self, args):
+        '''Return the result cache key for a call with the parsed values
+        args.'''
+        import hashlib
+        spec = self.spec()
+        names = [param.name for param in spec.positional]
+        values = [args[name] for name in names]
+        if spec.varargs is not None:
+            values.extend(args[spec.varargs.name])
+        files = []
+        for value in values:
+            if isinstance(value, str) and os.path.isfile(value):
+                if self.cache_files == 'hash':
+                    digest = hashlib.sha1()
+                    with open(value, 'rb') as input_file:
+                        for block in iter(
+                                lambda: input_file.read(1 << 16), b''):
+                            digest.update(block)
+                    files.append((value, digest.hexdigest()))
+                else:
+                    stat = os.stat(value)
+                    files.append((value, getattr(
+                        stat, 'st_mtime_ns', stat.st_mtime), stat.st_size))
+        key = repr((os.getcwd(), sorted(args.items()), files))
+        return hashlib.sha1(('%s\0%s' % (self._cache_key(), key)).encode(
+            'utf-8', 'surrogateescape')).hexdigest()
+
+    def _call_function(self, args):
+        if self.parallel:
+            call, arguments = self._call_parallel, args
+        else:
+            call, arguments = self._invoke, self.spec().arguments(args)
+        if self.diagnostics:
+            profile = args.pop(PROFILE_DEST, None)
+            trace = args.pop(TRACEMALLOC_DEST, None)
+            if profile or trace:
+                return self._diagnose(call, arguments, profile, trace)
+        if self.on_phase is None:
+            return call(arguments)
+        start = _clock_ns()
+        try:
+            return call(arguments)
+        finally:
+            self.on_phase('call', _clock_ns() - start)
+
+    def _diagnose(self, call, arguments, profile, trace):
+        '''Call call(arguments) under cProfile if profile (a path to write
+        the stats to) is set and tracing allocations if trace (a path to
+        write the report to) is.'''
+        if trace:
+            import tracemalloc
+            tracemalloc.start()
+        if profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            return call(arguments)
+        finally:
+            if profile:
+                profiler.disable()
+                profiler.dump_stats(profile)
+            if trace:
+                snapshot = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                _write_allocation_report(trace, snapshot, peak)
+
+    def _call_parallel(self, args):
+        '''Call the function once for each varargs item, the number of jobs
+        at a time, and return the highest exit status.'''
+        spec = self.spec()
+        name = spec.varargs.name
+        jobs = args.pop(JOBS_DEST)
+        if jobs < 0:
+            self.build().error('argument -j/--jobs: must not be negative')
+        if jobs == 0:
+            import multiprocessing
+            jobs = multiprocessing.cpu_count()
+        items = args[name]
+        if self.stream_varargs:
+            items = items[0]
+
+        def item_arguments():
+            for item in items:
+                args[name] = [item]
+                yield spec.arguments(args)
+
+        status = 0
+        if jobs == 1:
+            for arguments in item_arguments():
+                status = max(status, self._call_item(arguments, False)[0])
+            return status
+
+        import collections
+        import functools
+        from concurrent import futures
+        if self.executor == 'thread':
+            pool = futures.ThreadPoolExecutor(jobs)
+            submit = functools.partial(pool.submit, self._call_item)
+        else:
+            pool, command = self._process_pool(jobs)
+            submit = functools.partial(
+                pool.submit, _call_item_in_worker, command)
+        # Output is also captured while this thread's output is being
+        # recorded for the result cache, which only sees what the items
+        # write once it is passed on here.
+        capture = self.ordered_output or bool(
+            getattr(_captures, 'stack', None))
+
+        def finish(future):
+            item_status, output, errors = future.result()
+            if capture:
+                sys.stdout.write(output)
+                sys.stderr.write(errors)
+            return max(status, item_status)
+
+        pending = collections.deque()
+        try:
+            for arguments in item_arguments():
+                pending.append(submit(arguments, capture))
+                # Bound the calls in flight so streamed items are not all
+                # read ahead, as in run_many.
+                if len(pending) >= jobs * 2:
+                    status = finish(pending.popleft())
+            while pending:
+                status = finish(pending.popleft())
+        finally:
+            pool.shutdown(wait=not pending)
+            _forked_commands.pop(id(self), None)
+        return status
+
+    def _call_item(self, arguments, capture):
+        '''Call the function for one parallel item. Returns its exit status
+        and, if capture is true, what it wrote to stdout and to stderr.'''
+        if capture:
+            buffers = _start_capture(False)
+        try:
+            try:
+                status = exit_status(self._invoke(arguments))
+            except SystemExit as error:
+                status = exit_status(error.code)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                status = 1
+        finally:
+            if capture:
+                _stop_capture(buffers)
+        if capture:
+            return status, buffers[0].getvalue(), buffers[1].getvalue()
+        return status, None, None
+
+    def _invoke(self, arguments):
+        if self.is_async:
+            return self._run_coroutine(self.func(*arguments))
+        return self.func(*arguments)
+
+    def _run_coroutine(self, coroutine):
+        '''Run coroutine in a new event loop and return its result.'''
+        import asyncio
+        uvloop = None
+        if self.fast_loop:
+            try:
+                import uvloop
+            except ImportError:
+                pass
+        if hasattr(asyncio, 'Runner'):
+            factory = uvloop.new_event_loop if uvloop is not None else None
+            with asyncio.Runner(loop_factory=factory) as runner:
+                return runner.run(coroutine)
+        if uvloop is None:
+            return asyncio.run(coroutine)
+        # Run a loop of our own rather than installing uvloop's policy,
+        # which would change the loops of the whole process.
+        loop = uvloop.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            try:
+                loop.run_until_complete(loop.shutdown_asyncgens())
+            finally:
+                loop.close()
+
+    def __call__(self, argv=None):
+        if self.telemetry:
+            return self._recorded_call(argv)
+        try:
+            args = self._parse(argv)
+            # Streamed varargs are only converted as the function reads
+            # them, so errors can be reported while it runs.
+            return self._call(args)
+        except ParseError as error:
+            error.exit()
+
+    def _recorded_call(self, argv):
+        '''Call the command as __call__ does, sending a usage record to the
+        telemetry destination afterwards.'''
+        usage = record_usage()
+        options = None
+        status = 1
+        try:
+            try:
+                args = self._parse(argv)
+                options = [param.name for param in self.spec().options
+                           if not _is_default(args.get(param.name),
+                                              param.default)]
+                result = self._call(args)
+            except ParseError as error:
+                error.exit()
+            status = _exit_code(result)
+            return result
+        except SystemExit as error:
+            status = _exit_code(error.code)
+            raise
+        finally:
+            record = usage()
+            record.update(command=self.__name__, options=options,
+                          status=status)
+            telemetry_writer(self.telemetry).write(record)
+
+    def parse(self, argv):
+        '''Parse the argument list argv and return a dict of parameter name:
+        value pairs. Nothing is written to stdout or stderr: parse errors and
+        help requests raise ParseError, whose output attribute holds the text
+        that would have been printed. Safe to call from several threads at
+        once.'''
+        return self._parse(list(argv))
+
+    def invoke(self, argv):
+        '''Parse the argument list argv, call the decorated function and
+        return its value. Like parse, this never writes to stdout or stderr
+        or exits; parse errors and help requests raise ParseError. It is
+        safe to invoke a command from several threads at once, and calls
+        only wait for each other while the parser is first built.'''
+        return self._call(self._parse(list(argv)))
+
+    def call(self, **kwargs):
+        '''Call the decorated function with Python values for its
+        parameters, given by name, without going through the command line.
+        Options that aren't given get their defaults and varargs may be
+        given as any iterable. Raises TypeError for unknown or missing
+        parameters and ValueError for a value that isn't one of its
+        choices. Values are passed through as they are, not converted.'''
+        if self._call_table is None:
+            spec = self.spec()
+            defaults = dict((param.name, param.default)
+                            for param in spec.options)
+            if spec.varargs is not None:
+                defaults[spec.varargs.name] = ()
+            self._call_table = (
+                frozenset(param.name for param in spec.params), defaults,
+                [param.name for param in spec.positional],
+                [param for param in spec.options if param.choices is not None])
+        known, defaults, required, with_choices = self._call_table
+        for name in kwargs:
+            if name not in known:
+                raise TypeError('%s() got an unexpected parameter %r' % (
+                    self.__name__, name))
+        values = dict(defaults)
+        values.update(kwargs)
+        for name in required:
+            if name not in values:
+                raise TypeError('%s() missing required parameter %r' % (
+                    self.__name__, name))
+        for param in with_choices:
+            if (param.name in kwargs and
+                    kwargs[param.name] not in param.choices):
+                raise ValueError('%s: invalid choice: %r (choose from %s)' % (
+                    param.name, kwargs[param.name],
+                    ', '.join(repr(choice) for choice in param.choices)))
+        return self._invoke(self.spec().arguments(values))
+
+    def run_async(self, argv=None):
+        '''Parse argv and return the coroutine of the decorated async def
+        function without running it, so it can be awaited in an event loop
+        that is already running. Parse errors are handled as when calling
+        the command.'''
+        if not self.is_async:
+            raise TypeError('%s is not an async def function' % (
+                self.__name__,))
+        try:
+            args = self._parse(argv)
+        except ParseError as error:
+            error.exit()
+        return self.func(*self.spec().arguments(args))
+
+    def serve(self, path, max_requests=None):
+        '''Serve invocations of this command on a Unix domain socket at path,
+        keeping the interpreter warm with the parser built. Clients (see
+        run_client, or python -m opterator client PATH ARGS...) send their
+        argv, working directory, environment and stdio file descriptors;
+        each request is run in a forked child using them and its exit status
+        is sent back. Serves forever unless max_requests is given.'''
+        import array
+        import errno
+        import socket
+        import stat
+        self.spec()
+        if self.engine != 'fast':
+            self.build()
+        try:
+            mode = os.lstat(path).st_mode
+        except OSError:
+            pass
+        else:
+            # Replace the socket left by an earlier server, but nothing else.
+            if not stat.S_ISSOCK(mode):
+                raise OSError(errno.EEXIST, 'File exists and is not a socket',
+                              path)
+            os.remove(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(128)
+        fd_size = array.array('i').itemsize * 3
+        children = set()
+        served = 0
+        try:
+            while max_requests is None or served < max_requests:
+                connection, address = listener.accept()
+                served += 1
+                data, ancillary, flags, address = connection.recvmsg(
+                    65536, socket.CMSG_LEN(fd_size))
+                chunks = [data]
+                while True:
+                    chunk = connection.recv(65536)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                fds = array.array('i')
+                for level, kind, fd_data in ancillary:
+                    if level == socket.SOL_SOCKET and (
+                            kind == socket.SCM_RIGHTS):
+                        fds.frombytes(fd_data[:fd_size])
+                sys.stdout.flush()
+                sys.stderr.flush()
+                pid = os.fork()
+                if pid == 0:
+                    listener.close()
+                    self._serve_request(connection, b''.join(chunks), fds)
+                connection.close()
+                for fd in fds:
+                    os.close(fd)
+                children.add(pid)
+                for pid in list(children):
+                    if os.waitpid(pid, os.WNOHANG)[0]:
+                        children.discard(pid)
+        finally:
+            listener.close()
+            for pid in children:
+                os.waitpid(pid, 0)
+
+    def _serve_request(self, connection, data, fds):
+        '''Run one served request in a forked child process. Never returns.'''
+        status = 1
+        try:
+            argv, cwd, environ = _decode_request(data)
+            for target, fd in enumerate(fds):
+                os.dup2(fd, target)
+                os.close(fd)
+            # The server's own sys streams may have been replaced, so bind
+            # fresh ones to the client's descriptors.
+            sys.stdin = os.fdopen(0, 'r', closefd=False)
+            sys.stdout = os.fdopen(1, 'w', closefd=False)
+            sys.stderr = os.fdopen(2, 'w', closefd=False)
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(environ)
+            if argv[0]:
+                sys.argv = argv
+                if self._parser is not None:
+                    self._parser.prog = os.path.basename(argv[0])
+            try:
+                result = self(argv[1:])
+                # Only parallel commands return an exit status; other
+                # values are data for callers, as when run directly.
+                status = exit_status(result) if self.parallel else 0
+            except SystemExit as error:
+                status = exit_status(error.code)
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                connection.sendall(str(status).encode('ascii'))
+                connection.close()
+            finally:
+                flush_telemetry()
+                os._exit(0)
+
+    def __reduce__(self):
+        # Pickle by reference, as pickle does for functions, so workers
+        # import the module and get the command (with its spec cache).
+        return (_resolve_type, (self._reference(),))
+
+    def _reference(self):
+        '''Return the module:qualname of this command. Raises
+        pickle.PicklingError if importing that doesn't give this object.'''
+        reference = '%s:%s' % (self.__module__, getattr(
+            self.func, '__qualname__', self.__name__))
+        try:
+            found = _resolve_type(reference)
+        except (ImportError, AttributeError):
+            found = None
+        if found is not self:
+            import pickle
+            raise pickle.PicklingError(
+                "Can't pickle %r: it's not the same object as %s" % (
+                    self, reference))
+        return reference
+
+    def _process_pool(self, workers):
+        '''Return a ProcessPoolExecutor with workers processes and what to
+        pass to _worker_command in them to get this command: the command,
+        if it can be pickled, or else a key for a pool of processes forked
+        from this one.'''
+        import multiprocessing
+        import pickle
+        from concurrent import futures
+        try:
+            self._reference()
+        except pickle.PicklingError:
+            _forked_commands[id(self)] = self
+            pool = futures.ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context('fork'))
+            return pool, id(self)
+        return futures.ProcessPoolExecutor(workers), self
+
+    def _run_one(self, argv):
+        try:
+            args = self._parse(argv)
+        except ParseError as error:
+            return RunResult(argv, error=error, status=error.status)
+        try:
+            return RunResult(argv, value=self._call(args))
+        except SystemExit as error:
+            return RunResult(argv, status=_exit_code(error.code))
+
+    def run_many(self, argvs, workers=None, executor='thread'):
+        '''Invoke the command once for each argument list in the iterable
+        argvs, yielding a RunResult for each in order. Unlike calling the
+        command, parse errors and help requests are reported in the result
+        rather than printed, and never exit the process; neither does a
+        SystemExit raised by the decorated function, whose status is
+        recorded in the result. Other exceptions it raises propagate.
+
+        The parser is built once and reused. argvs is consumed lazily, so it
+        may be a generator over a large file of command lines. If workers is
+        given, invocations run concurrently on that many threads, or on
+        forked processes if executor is 'process'.'''
+        if not workers:
+            for argv in argvs:
+                yield self._run_one(argv)
+            return
+
+        import collections
+        import functools
+        from concurrent import futures
+        if executor == 'thread':
+            pool = futures.ThreadPoolExecutor(workers)
+            submit = functools.partial(pool.submit, self._run_one)
+        elif executor == 'process':
+            pool, command = self._process_pool(workers)
+            submit = functools.partial(pool.submit, _run_in_worker, command)
+        else:
+            raise ValueError('unknown executor %r' % (executor,))
+
+        self.spec()
+        if self.engine != 'fast':
+            self.build()
+        pending = collections.deque()
+        try:
+            for argv in argvs:
+                pending.append(submit(argv))
+                # Keep a bounded number of invocations in flight so argvs
+                # is never read far ahead of the results.
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            pool.shutdown(wait=False)
+            _forked_commands.pop(id(self), None)
+
+
+def load_command(target):
+    """Import and return the object named by target, in module:attribute
+    form, for example 'examples.cp:main'."""
+    import importlib
+    module_name, sep, attributes = target.partition(':')
+    if not sep or not attributes:
+        raise ValueError('expected module:function, got %r' % (target,))
+    # Import from the working directory, as python -m would, without
+    # leaving it on sys.path.
+    added = '' not in sys.path
+    if added:
+        sys.path.insert(0, '')
+    try:
+        obj = importlib.import_module(module_name)
+    finally:
+        if added and '' in sys.path:
+            sys.path.remove('')
+    for attribute in attributes.split('.'):
+        obj = getattr(obj, attribute)
+    return obj
+
+
+HELP_OPTION = (['-h', '--help'], 'show this help message and exit')
+
+
+def _completion_options(command):
+    """Return (option_strings, help, takes_value, choices, repeatable)
+    tuples for command's options, including -h."""
+    options = [(HELP_OPTION[0], HELP_OPTION[1], False, None, False)]
+    for param in command.spec().options:
+        choices = None
+        if param.choices is not None:
+            choices = [str(choice) for choice in param.choices]
+        options.append((param.names, param.help,
+                        param.action in ('store', 'append'), choices,
+                        param.action == 'append'))
+    if command.parallel:
+        options.append((JOBS_OPTIONS, 'process N items at once', True, None,
+                        False))
+    return options
+
+
+def _bash_completion(command, prog, name):
+    import shlex
+    cases = []
+    words = []
+    for names, help_text, takes_value, choices, repeatable in (
+            _completion_options(command)):
+        words.extend(names)
+        if choices is not None:
+            reply = 'compgen -W %s -- "$cur"' % shlex.quote(
+                ' '.join(choices))
+        elif takes_value:
+            reply = 'compgen -f -- "$cur"'
+        else:
+            continue
+        cases.append('        %s) COMPREPLY=($(%s)); return;;' % (
+            '|'.join(names), reply))
+    lines = [
+        '# bash completion for %s, generated by opterator' % prog,
+        '%s() {' % name,
+        '    local cur="${COMP_WORDS[COMP_CWORD]}"',
+        '    local prev="${COMP_WORDS[COMP_CWORD-1]}"',
+    ]
+    if cases:
+        lines.append('    case "$prev" in')
+        lines.extend(cases)
+        lines.append('    esac')
+    lines.extend([
+        '    if [[ "$cur" == -* ]]; then',
+        '        COMPREPLY=($(compgen -W %s -- "$cur"))' % shlex.quote(
+            ' '.join(words)),
+        '    else',
+        '        COMPREPLY=($(compgen -f -- "$cur"))',
+        '    fi',
+        '}',
+        'complete -F %s %s' % (name, shlex.quote(prog)),
+    ])
+    return '\n'.join(lines) + '\n'
+
+
+def _zsh_quote(text):
+    return "'%s'" % text.replace("'", "'\\''")
+
+
+def _zsh_escape(text):
+    for char in '\\[]:':
+        text = text.replace(char, '\\' + char)
+    return text
+
+
+def _zsh_completion(command, prog, name):
+    spec = command.spec()
+    arguments = []
+    for names, help_text, takes_value, choices, repeatable in (
+            _completion_options(command)):
+        if repeatable:
+            prefix = "'*'"
+        elif len(names) > 1:
+            prefix = "'(%s)'" % ' '.join(names)
+        else:
+            prefix = ''
+        if len(names) > 1:
+            option = prefix + '{%s}' % ','.join(names)
+        else:
+            option = prefix + names[0]
+        value = ''
+        if choices is not None:
+            value = ':%s:(%s)' % (
+                names[-1].lstrip('-'),
+                ' '.join(_zsh_escape(choice) for choice in choices))
+        elif takes_value:
+            value = ':%s:_files' % names[-1].lstrip('-')
+        arguments.append(
+            option + _zsh_quote('[%s]' % _zsh_escape(help_text) + value))
+    for position, param in enumerate(spec.positional, 1):
+        arguments.append(_zsh_quote('%d:%s:_files' % (position, param.name)))
+    if spec.varargs:
+        arguments.append(_zsh_quote('*:%s:_files' % spec.varargs.name))
+    lines = [
+        '#compdef %s' % prog,
+        '# zsh completion for %s, generated by opterator' % prog,
+        '%s() {' % name,
+        '    _arguments -s \\',
+    ]
+    lines.extend('        %s \\' % argument for argument in arguments[:-1])
+    lines.append('        %s' % arguments[-1])
+    lines.extend(['}', 'compdef %s %s' % (name, prog)])
+    return '\n'.join(lines) + '\n'
+
+
+def _fish_quote(text):
+    return "'%s'" % text.replace('\\', '\\\\').replace("'", "\\'")
+
+
+def _fish_completion(command, prog, name):
+    lines = ['# fish completion for %s, generated by opterator' % prog]
+    for names, help_text, takes_value, choices, repeatable in (
+            _completion_options(command)):
+        words = ['complete', '-c', _fish_quote(prog)]
+        for option in names:
+            if option.startswith('--'):
+                words.extend(['-l', _fish_quote(option[2:])])
+            elif len(option) == 2:
+                words.extend(['-s', _fish_quote(option[1:])])
+            else:
+                words.extend(['-o', _fish_quote(option[1:])])
+        if choices is not None:
+            words.extend(['-x', '-a', _fish_quote(' '.join(choices))])
+        elif takes_value:
+            words.append('-r')
+        if help_text:
+            words.extend(['-d', _fish_quote(help_text)])
+        lines.append(' '.join(words))
+    return '\n'.join(lines) + '\n'
+
+
+COMPLETION_SHELLS = {
+    'bash': _bash_completion,
+    'zsh': _zsh_completion,
+    'fish': _fish_completion,
+}
+
+
+def completion_script(command, shell, prog):
+    """Return a self-contained script for shell ('bash', 'zsh' or 'fish')
+    that completes the options, choices and file arguments of the opterate
+    decorated command when invoked as prog, without running Python."""
+    try:
+        generate = COMPLETION_SHELLS[shell]
+    except KeyError:
+        raise ValueError('unsupported shell %r' % (shell,))
+    name = '_opterator_' + ''.join(
+        char if char.isalnum() else '_' for char in prog)
+    return generate(command, prog, name)
+
+
+@opterate
+def _completion_main(shell, target, prog=''):
+    """Print a shell completion script for an opterate decorated command.
+    Source the output from your shell startup file (or, for fish, save it
+    in ~/.config/fish/completions/).
+
+    :param shell: bash, zsh or fish
+    :param target: the command, as module:function
+    :param prog: -p --prog the command name to complete; defaults to the
+        last component of the module name"""
+    if shell not in COMPLETION_SHELLS:
+        sys.exit('unsupported shell %r; choose from %s' % (
+            shell, ', '.join(sorted(COMPLETION_SHELLS))))
+    command = load_command(target)
+    prog = prog or target.partition(':')[0].rpartition('.')[2]
+    sys.stdout.write(completion_script(command, shell, prog))
+
+
+# Features of a Command that compile_command can't reproduce.
+UNCOMPILABLE = ('vectorize', 'stream_varargs', 'parallel', 'config',
+                'env_prefix', 'diagnostics', 'telemetry', 'cache')
+
+COMPILED_TEMPLATE = '''# Generated by python -m opterator compile %(target)s
+# Regenerate this file when the signature or docstring of the function
+# changes.
+"""Command line entry point for %(target)s that parses arguments without
+introspecting the function or importing argparse. Anything the parser
+doesn't handle is passed to the decorated command itself."""
+import os
+import sys
+%(imports)s
+from %(module)s import %(attribute)s as COMMAND
+
+FUNC = COMMAND.__wrapped__
+DEFAULTS = FUNC.__defaults__ or ()
+PROG = %(prog)r
+HELP = %(help)r
+ORDER = %(order)r
+VARARGS = %(varargs_name)r
+TABLE = (
+    {
+%(options)s
+    },
+    (%(positional)s),
+    %(varargs)s,
+    {
+%(defaults)s
+    },
+)
+
+
+%(parser)s
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if (len(argv) == 1 and argv[0] in ('-h', '--help') and
+            os.path.basename(sys.argv[0]) == PROG):
+        sys.stdout.write(HELP)
+        sys.exit(0)
+    try:
+        values = fast_parse(TABLE, argv)
+    except _NotHandled:
+        return COMMAND(argv)
+    args = tuple([values[name] for name in ORDER])
+    if VARARGS:
+        args += tuple(values[VARARGS])
+%(call)s
+
+
+if __name__ == '__main__':
+    main()
+'''
+
+
+def compile_command(command, target, prog):
+    '''Return the source of a module whose main() function parses the
+    command line for command, the opterate decorated object named by target
+    (module:attribute), and calls its function. The parser and its tables
+    are generated from the spec, and the help is rendered now for prog at
+    the current terminal width. Raises ValueError if the command uses
+    features the generated parser doesn't support.'''
+    import inspect
+    for feature in UNCOMPILABLE:
+        if getattr(command, feature):
+            raise ValueError('cannot compile a command that uses %s' % (
+                feature,))
+    spec = command.spec()
+    if fast_parse_table(spec) is None:
+        raise ValueError('cannot convert the default of an option')
+    imports = set()
+
+    def converter_source(converter):
+        reference = _type_reference(converter)
+        if reference is None:
+            return 'None'
+        module, name = reference.split(':')
+        if module in ('builtins', '__builtin__'):
+            return name
+        imports.add(module)
+        return '%s.%s' % (module, name)
+
+    options = []
+    defaults = []
+    for index, param in enumerate(spec.options):
+        converter = converter_source(param.type)
+        choices = 'None'
+        if param.choices is not None:
+            choices = 'DEFAULTS[%d]' % index
+        for name in param.names:
+            options.append('        %r: (%r, %r, %s, %s),' % (
+                name, param.name, param.action, choices, converter))
+        default = 'DEFAULTS[%d]' % index
+        if param.type is not None and isinstance(param.default, str):
+            default = '%s(%s)' % (converter, default)
+        defaults.append('        %r: %s,' % (param.name, default))
+    positional = ''.join('(%r, %s), ' % (
+        param.name, converter_source(param.type))
+        for param in spec.positional)
+    varargs = 'None'
+    if spec.varargs is not None:
+        varargs = '(%r, %s)' % (
+            spec.varargs.name, converter_source(spec.varargs.type))
+    call = '    return FUNC(*args)'
+    if command.is_async:
+        call = '    import asyncio\n    return asyncio.run(FUNC(*args))'
+    parser = command.build()
+    saved_prog, parser.prog = parser.prog, prog
+    try:
+        help_text = parser.format_help()
+    finally:
+        parser.prog = saved_prog
+    module, attribute = target.split(':')
+    return COMPILED_TEMPLATE % {
+        'target': target,
+        'module': module,
+        'attribute': attribute,
+        'imports': ''.join('import %s\n' % name for name in sorted(imports)),
+        'prog': prog,
+        'help': help_text,
+        'order': tuple(param.name for param in spec.positional) +
+        tuple(param.name for param in spec.options),
+        'varargs_name': spec.varargs.name if spec.varargs else None,
+        'options': '\n'.join(options),
+        'positional': positional,
+        'varargs': varargs,
+        'defaults': '\n'.join(defaults),
+        'parser': '\n\n'.join(inspect.getsource(obj) for obj in (
+            _NotHandled, fast_parse, _fast_convert)),
+        'call': call,
+    }
+
+
+@opterate
+def _compile_main(target, output='', prog=''):
+    """Write a module that parses the command line for an opterate decorated
+    command without introspection or argparse, and calls its function. Run
+    the module itself, or call its main() function.
+
+    :param target: the command, as module:function
+    :param output: -o --output the file to write; defaults to stdout
+    :param prog: -p --prog the program name shown in the help; defaults to
+        the name of the output file"""
+    command = load_command(target)
+    if not isinstance(command, Command):
+        sys.exit('%s is not an opterate decorated function' % (target,))
+    prog = prog or os.path.basename(output) or target.partition(
+        ':')[0].rpartition('.')[2]
+    try:
+        source = compile_command(command, target, prog)
+    except ValueError as error:
+        sys.exit('cannot compile %s: %s' % (target, error))
+    if not output:
+        sys.stdout.write(source)
+        return
+    with open(output, 'w') as output_file:
+        output_file.write(source)
+
+
+SUBCOMMANDS = {
+    'compile': _compile_main,
+    'completion': _completion_main,
+}
+
+
+def _main(argv=None):
+    """Entry point for python -m opterator."""
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) >= 2 and argv[0] == 'client':
+        # Parsed by hand so that the forwarded arguments are passed verbatim
+        # and the client starts as quickly as possible.
+        return run_client(argv[1], [''] + argv[2:])
+    if argv and argv[0] in SUBCOMMANDS:
+        command = SUBCOMMANDS[argv[0]]
+        command.build().prog = 'python -m opterator %s' % argv[0]
+        return command(argv[1:])
+    sys.stderr.write(
+        'usage: python -m opterator client PATH [ARG ...]\n'
+        '       python -m opterator completion {bash,zsh,fish} '
+        'MODULE:FUNCTION [-p PROG]\n'
+        '       python -m opterator compile MODULE:FUNCTION [-o FILE] '
+        '[-p PROG]\n')
+    return 2
+
+
+if __name__ == '__main__':
+    from opterator import _main
+    sys.exit(_main())
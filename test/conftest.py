@@ -1,5 +1,6 @@
 # py.test plugin to ignore collection of unit tests in test files
-# that use python 3 syntax that fails to compile under python 2.
+# that use python 3 syntax that fails to compile under python 2, or
+# interpreter features that older versions lack.
 # These test advanced features that aren't available in python 2.
 
 import sys
@@ -9,4 +10,10 @@ def pytest_ignore_collect(path, config):
     if path.basename == 'test_function_annotations.py':
         if sys.version_info < (3, 3):
             return True
+    if path.basename == 'test_async.py':
+        if sys.version_info < (3, 7):
+            return True
+    if path.basename == 'test_import_time.py':
+        if sys.version_info < (3, 8):
+            return True
     return False
@@ -0,0 +1,74 @@
+from opterator import opterate
+import asyncio
+import sys
+import types
+import pytest
+
+
+class Checker(object):
+    '''Just something to get closure-like behaviour so I can call the internal
+    function and set or check values to ensure the decorator is behaving
+    correctly.'''
+    pass
+
+
+def test_async_main():
+    result = Checker()
+
+    @opterate
+    async def main(name, count=1):
+        await asyncio.sleep(0)
+        result.loop = asyncio.get_running_loop()
+        return [name] * count
+
+    assert main.is_async
+    assert main(['x', '-c', '3']) == ['x', 'x', 'x']
+    first = result.loop
+    main(['y'])
+    assert result.loop is not first
+    with pytest.raises(SystemExit):
+        main([])
+
+
+def test_run_async():
+    @opterate
+    async def main(name):
+        await asyncio.sleep(0)
+        return name.upper()
+
+    async def caller():
+        return await asyncio.gather(*[main.run_async([str(i) + 'a'])
+                                      for i in range(3)])
+    assert asyncio.run(caller()) == ['0A', '1A', '2A']
+
+    @opterate
+    def plain(name):
+        pass
+    with pytest.raises(TypeError):
+        plain.run_async(['x'])
+
+
+def test_fast_loop(monkeypatch):
+    created = []
+
+    def new_event_loop():
+        created.append(asyncio.new_event_loop())
+        return created[-1]
+    uvloop = types.ModuleType('uvloop')
+    uvloop.new_event_loop = new_event_loop
+    uvloop.EventLoopPolicy = asyncio.DefaultEventLoopPolicy
+    monkeypatch.setitem(sys.modules, 'uvloop', uvloop)
+
+    @opterate(fast_loop=True)
+    async def main():
+        return asyncio.get_running_loop()
+    policy = asyncio.get_event_loop_policy()
+    loop = main([])
+    assert created == [loop]
+    assert loop.is_closed()
+    # Without asyncio.Runner (before Python 3.11).
+    monkeypatch.delattr(asyncio, 'Runner', raising=False)
+    loop = main([])
+    assert created[1:] == [loop]
+    assert loop.is_closed()
+    assert asyncio.get_event_loop_policy() is policy
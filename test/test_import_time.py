@@ -0,0 +1,21 @@
+'''Guard the time it takes to import opterator. Needs -X importtime and
+-X pycache_prefix, so conftest.py skips it before Python 3.8.'''
+from test.test_startup import run_python
+
+# Cumulative import time for opterator, in microseconds. Generous enough to
+# absorb slow machines, but far below the cost of argparse plus inspect.
+IMPORT_TIME_BUDGET = 5000
+
+
+def test_import_time_budget(tmpdir):
+    # Byte-compile into a private cache first so only the import is timed.
+    prefix = 'pycache_prefix=%s' % tmpdir
+    run_python('import opterator', '-X', prefix)
+    output = run_python('import opterator', '-X', prefix, '-X', 'importtime')
+    for line in output.splitlines():
+        if line.rstrip().endswith('| opterator'):
+            cumulative = int(line.split('|')[1])
+            break
+    else:
+        raise AssertionError('no import time reported:\n' + output)
+    assert cumulative < IMPORT_TIME_BUDGET
@@ -1,7 +1,17 @@
 from opterator import opterate
+import pytest
+import os
+import sys
+import time
 import py
 
 
+@opterate
+def picklable_command(word, count=1):
+    print(word * int(count))
+    return os.getpid()
+
+
 class Checker(object):
     '''Just something to get closure-like behaviour so I can call the internal
     function and set or check values to ensure the decorator is behaving
@@ -621,3 +631,1052 @@ optional arguments:
     assert result.interactive is True
     assert result.suffix == '~'
     assert result.other_filenames == ('another', 'directory')
+
+
+def test_parser_built_lazily():
+    result = Checker()
+
+    @opterate
+    def main(source, verbose=False):
+        '''A script with a lazily built parser.
+        :param verbose: -v --verbose be chatty'''
+        result.source = source
+        result.verbose = verbose
+    assert main._parser is None
+
+    main(['thesource', '-v'])
+    parser = main._parser
+    assert parser is not None
+    assert result.source == 'thesource'
+    assert result.verbose is True
+
+    main(['othersource'])
+    assert main._parser is parser
+    assert result.source == 'othersource'
+    assert result.verbose is False
+
+
+def test_build_is_memoized():
+    @opterate
+    def main(myoption='novalue'):
+        '''A script with one optional option.'''
+        pass
+    parser = main.build()
+    assert main.build() is parser
+    assert main.__name__ == 'main'
+    assert main.__doc__ == 'A script with one optional option.'
+
+
+def test_spec_cache_roundtrip(tmpdir, monkeypatch):
+    import opterator
+    result = Checker()
+
+    def main(source, myoption='novalue', verbose=False, *others):
+        '''A script with a cached spec.
+        :param source: where to start
+        :param myoption: -m --mine the myoption helptext'''
+        result.source = source
+        result.myoption = myoption
+        result.verbose = verbose
+        result.others = others
+
+    opterate(spec_cache=str(tmpdir))(main)(['src'])
+    assert len(tmpdir.listdir()) == 1
+
+    def fail(*args):
+        raise AssertionError('spec should have come from the cache')
+    monkeypatch.setattr(opterator.CommandSpec, 'from_function', fail)
+    command = opterate(spec_cache=str(tmpdir))(main)
+    command(['-m', 'avalue', '-v', 'src2', 'more'])
+    assert command.spec().description == 'A script with a cached spec.'
+    assert command.spec().options[1].default is False
+    assert result.source == 'src2'
+    assert result.myoption == 'avalue'
+    assert result.verbose is True
+    assert result.others == ('more',)
+
+
+def test_spec_cache_from_environment(tmpdir, monkeypatch):
+    monkeypatch.setenv('OPTERATOR_CACHE_DIR', str(tmpdir))
+
+    @opterate
+    def main(myoption='novalue'):
+        pass
+    main([])
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_spec_cache_key_tracks_docstring():
+    from opterator import spec_cache_key
+
+    def main(myoption='novalue'):
+        '''first'''
+    key = spec_cache_key(main)
+    main.__doc__ = 'second'
+    assert spec_cache_key(main) != key
+
+
+def test_spec_cache_key_tracks_choice_types():
+    from opterator import spec_cache_key
+
+    def main(level=['a', 'b']):
+        return level
+    key = spec_cache_key(main)
+    main.__defaults__ = ([1, 2],)
+    assert spec_cache_key(main) != key
+
+
+def test_spec_cache_key_is_stable_across_processes(tmpdir):
+    import subprocess
+    code = '''
+import opterator
+def size(text):
+    return int(text)
+def main(limit=0):
+    pass
+main.__annotations__ = {'limit': size}
+print(opterator.spec_cache_key(main))
+'''
+    environ = dict(os.environ, PYTHONPATH=os.path.dirname(
+        os.path.dirname(os.path.abspath(__file__))))
+    keys = set(subprocess.check_output([sys.executable, '-c', code],
+                                       env=environ) for i in range(2))
+    assert len(keys) == 1
+
+
+def test_fast_engine():
+    result = Checker()
+
+    @opterate(engine='fast')
+    def main(filename1, filename2, recursive=False, suffix='~',
+             mode=['fast', 'slow'], tags=[], *other_filenames):
+        '''A copy script parsed by the fast engine.
+        :param recursive: -r --recursive copy directories recursively
+        :param suffix: -S --suffix override the usual backup suffix'''
+        result.args = (filename1, filename2, recursive, suffix, mode, tags,
+                       other_filenames)
+
+    main(['-r', 'source', 'dest', '--suffix=.bak', '-t', 'a', '-t', 'b'])
+    assert result.args == ('source', 'dest', True, '.bak', ['fast', 'slow'],
+                           ['a', 'b'], ())
+    main(['source', '-m', 'slow', 'dest', 'another', 'directory'])
+    assert result.args == ('source', 'dest', False, '~', 'slow', [],
+                           ('another', 'directory'))
+    assert main._parser is None
+
+
+def test_fast_engine_falls_back_to_argparse():
+    result = Checker()
+
+    @opterate(engine='fast')
+    def main(source, recursive=False, interactive=False):
+        '''A script using combined short options.'''
+        result.args = (source, recursive, interactive)
+
+    main(['-ri', 'source'])
+    assert result.args == ('source', True, True)
+    assert main._parser is not None
+    pytest.raises(SystemExit, main, ['source', '--invalidopt'])
+
+
+def test_unknown_engine():
+    pytest.raises(ValueError, opterate(engine='turbo'), lambda: None)
+
+
+def test_run_many():
+    @opterate
+    def main(source, count='1'):
+        '''A script run in batches.'''
+        if source == 'bad':
+            sys.exit(3)
+        return source * int(count)
+
+    def argvs():
+        yield ['a']
+        yield ['b', '-c', '3']
+        yield ['c', '--invalidopt']
+        yield ['-h']
+        yield ['bad']
+        yield ['d']
+
+    results = list(main.run_many(argvs()))
+    assert [r.argv for r in results] == [
+        ['a'], ['b', '-c', '3'], ['c', '--invalidopt'], ['-h'], ['bad'],
+        ['d']]
+    assert [r.value for r in results] == [
+        'a', 'bbb', None, None, None, 'd']
+    assert [r.status for r in results] == [0, 0, 2, 0, 3, 0]
+    assert results[0].error is None
+    assert results[4].error is None
+    assert results[2].error.status == 2
+    assert results[2].error.stream == 'stderr'
+    assert 'unrecognized arguments: --invalidopt' in results[2].error.output
+    assert results[3].error.status == 0
+    assert results[3].error.output.startswith('usage: ')
+
+
+def test_run_many_workers():
+    @opterate(engine='fast')
+    def main(number):
+        if number == '7':
+            sys.exit(7)
+        return int(number) ** 2
+
+    argvs = ([str(n)] for n in range(50))
+    for executor in ('thread', 'process'):
+        results = list(main.run_many(argvs, workers=4, executor=executor))
+        assert [r.value for r in results] == [
+            None if n == 7 else n ** 2 for n in range(50)]
+        assert [r.status for r in results if r.status] == [7]
+        argvs = ([str(n)] for n in range(50))
+
+
+def test_serve(tmpdir):
+    import threading
+    from opterator import run_client
+
+    @opterate
+    def main(source, verbose=False):
+        '''A script served over a socket.'''
+        print('%s %s %s' % (source, verbose, os.environ.get('SERVED_VAR')))
+        if source == 'fail':
+            sys.exit(3)
+        if source == 'return':
+            return 'returned'
+
+    path = str(tmpdir.join('sock'))
+    server = threading.Thread(target=main.serve, args=(path, 4))
+    server.start()
+    while not os.path.exists(path):
+        time.sleep(0.01)
+    output = tmpdir.join('out')
+    errors = tmpdir.join('err')
+    os.environ['SERVED_VAR'] = 'forwarded'
+    try:
+        with open(os.devnull) as stdin, open(str(output), 'w') as stdout, \
+                open(str(errors), 'w') as stderr:
+            fds = (stdin.fileno(), stdout.fileno(), stderr.fileno())
+            assert run_client(path, ['prog', 'src', '-v'], fds) == 0
+            assert run_client(path, ['prog', 'fail'], fds) == 3
+            assert run_client(path, ['prog', '--bad'], fds) == 2
+            assert run_client(path, ['prog', 'return'], fds) == 0
+    finally:
+        del os.environ['SERVED_VAR']
+    server.join()
+    assert output.read() == (
+        'src True forwarded\nfail False forwarded\nreturn False forwarded\n')
+    errors = errors.read()
+    assert 'usage: prog [-h] [-v] source' in errors
+    assert 'returned' not in errors
+
+    # The socket left behind is replaced, but other files are not.
+    main.serve(path, 0)
+    with pytest.raises(OSError):
+        main.serve(str(output), 0)
+    assert output.read().startswith('src True forwarded\n')
+
+    # A parallel command returns the highest exit status of its items.
+    @opterate(parallel='varargs')
+    def each(*items):
+        if items[0] == 'bad':
+            sys.exit(3)
+    path = str(tmpdir.join('parallel.sock'))
+    server = threading.Thread(target=each.serve, args=(path, 1))
+    server.start()
+    while not os.path.exists(path):
+        time.sleep(0.01)
+    with open(os.devnull) as stdin, open(os.devnull, 'w') as stdout:
+        fds = (stdin.fileno(), stdout.fileno(), stdout.fileno())
+        assert run_client(path, ['prog', 'a', 'bad', 'b'], fds) == 3
+    server.join()
+
+
+def test_completion_scripts():
+    from opterator import completion_script
+
+    @opterate
+    def main(source, mode=['fast', 'slow'], suffix='~', tags=[],
+             verbose=False):
+        '''A script to complete.
+        :param mode: -m --mode how to go
+        :param verbose: -v be chatty'''
+
+    bash = completion_script(main, 'bash', 'my-tool')
+    assert "-m|--mode) COMPREPLY=($(compgen -W 'fast slow' --" in bash
+    assert "-s|--suffix) COMPREPLY=($(compgen -f --" in bash
+    assert "'-h --help -m --mode -s --suffix -t --tags -v'" in bash
+    assert bash.endswith('complete -F _opterator_my_tool my-tool\n')
+
+    zsh = completion_script(main, 'zsh', 'my-tool')
+    assert "'(-m --mode)'{-m,--mode}'[how to go]:mode:(fast slow)'" in zsh
+    assert "'*'{-t,--tags}'[]:tags:_files'" in zsh
+    assert "-v'[be chatty]'" in zsh
+    assert "'1:source:_files'" in zsh
+
+    fish = completion_script(main, 'fish', 'my-tool')
+    assert ("complete -c 'my-tool' -s 'm' -l 'mode' -x -a 'fast slow' "
+            "-d 'how to go'") in fish
+    assert "complete -c 'my-tool' -s 'v' -d 'be chatty'" in fish
+
+    pytest.raises(ValueError, completion_script, main, 'tcsh', 'my-tool')
+
+
+def test_on_phase():
+    phases = []
+
+    @opterate(on_phase=lambda name, elapsed: phases.append((name, elapsed)))
+    def main(source, verbose=False):
+        '''A timed script.
+        :param verbose: -v be chatty'''
+    main(['src', '-v'])
+    assert [name for name, elapsed in phases] == [
+        'argspec', 'docstring', 'options', 'add_arguments', 'parse', 'call']
+    assert all(elapsed >= 0 for name, elapsed in phases)
+
+
+def test_trace_environment(tmpdir, monkeypatch):
+    import json
+    trace = tmpdir.join('trace.jsonl')
+    monkeypatch.setenv('OPTERATOR_TRACE', str(trace))
+
+    @opterate(engine='fast')
+    def main(source):
+        pass
+    main(['src'])
+    records = [json.loads(line) for line in trace.readlines()]
+    assert [r['phase'] for r in records] == [
+        'argspec', 'docstring', 'options', 'parse', 'call']
+    assert all(r['command'] == 'main' for r in records)
+
+    missing = tmpdir.join('missing', 'trace.jsonl')
+    monkeypatch.setenv('OPTERATOR_TRACE', str(missing))
+    import subprocess
+    environ = dict(os.environ, PYTHONPATH=os.path.dirname(
+        os.path.dirname(os.path.abspath(__file__))))
+    assert subprocess.call(
+        [sys.executable, '-c', 'import opterator'], env=environ) == 0
+
+    @opterate
+    def other(source):
+        return source
+    assert other(['src']) == 'src'
+    assert not missing.check()
+
+
+def test_explicit_short_options_are_reserved():
+    result = Checker()
+
+    @opterate
+    def main(host='localhost', mode='fast', message=''):
+        '''Explicit short options claimed after automatic ones.
+        :param message: -m the message to send'''
+        result.args = (host, mode, message)
+
+    main(['-o', 'remote', '-d', 'slow', '-m', 'hi'])
+    assert result.args == ('remote', 'slow', 'hi')
+
+
+def test_allocate_options():
+    from opterator import allocate_options
+    params = ['abc', 'cab', 'bca', 'abc2', 'h_opt']
+    assert allocate_options(params, {'cab': ['-x']}) == {
+        'abc': ['-a', '--abc'], 'cab': ['-x'], 'bca': ['-b', '--bca'],
+        'abc2': ['-c', '--abc2'], 'h_opt': ['-_', '--h_opt']}
+    assert allocate_options(['ab', 'ba', 'ab2', 'x'], fallback=True) == {
+        'ab': ['-a', '--ab'], 'ba': ['-b', '--ba'], 'ab2': ['-2', '--ab2'],
+        'x': ['-x', '--x']}
+    assert allocate_options(['ab', 'ba', 'aba'], fallback=True)['aba'] == [
+        '-A', '--aba']
+    assert allocate_options(['ab', 'ba', 'aba'])['aba'] == ['--aba']
+
+
+def test_short_option_fallback():
+    result = Checker()
+
+    @opterate(short_option_fallback=True)
+    def main(verbose=False, value='', vv=False):
+        result.args = (verbose, value, vv)
+
+    main(['-V', '-a', 'x'])
+    assert result.args == (False, 'x', True)
+
+
+def test_wide_signature():
+    names = ['option_%d' % index for index in range(500)]
+    namespace = {}
+    exec('def main(%s):\n    return locals()' % ', '.join(
+        '%s=False' % name for name in names), namespace)
+    main = opterate(short_option_fallback=True)(namespace['main'])
+    assert main(['--option_499', '-o'])['option_499'] is True
+
+
+def test_google_docstring():
+    result = Checker()
+
+    @opterate
+    def main(source, suffix='~', verbose=False):
+        '''Copy a file.
+
+        Args:
+            source (str): the file to
+                copy
+            suffix: -S --suffix the backup suffix
+            verbose (bool): be chatty
+
+        Returns:
+            nothing: worth mentioning
+        '''
+        result.args = (source, suffix, verbose)
+
+    main(['src', '-S', '.bak', '-v'])
+    assert result.args == ('src', '.bak', True)
+    from opterator import parse_docstring
+    assert parse_docstring(main.__doc__) == ('Copy a file.', {
+        'source': ('the', 'file', 'to', 'copy'),
+        'suffix': ('-S', '--suffix', 'the', 'backup', 'suffix'),
+        'verbose': ('be', 'chatty')})
+
+
+def test_rest_docstring_with_google_header_line():
+    from opterator import parse_docstring
+    doc = '''Copy a file.
+
+    Examples:
+    copy.py a b
+
+    Note:
+    the destination is overwritten.
+
+    :param source: the file to copy
+    :param dest: where to copy it
+
+    Returns:
+        the status
+    '''
+    assert parse_docstring(doc) == (
+        'Copy a file.\n\n    Examples:\n    copy.py a b\n\n    Note:\n'
+        '    the destination is overwritten.', {
+            'source': ('the', 'file', 'to', 'copy'),
+            'dest': ('where', 'to', 'copy', 'it')})
+
+
+def test_plain_docstring_with_section_lines():
+    from opterator import parse_docstring
+    doc = '''List files.
+
+    Example:
+        ls.py -l /tmp
+
+    Notes
+    -----
+    Hidden files are skipped.'''
+    assert parse_docstring(doc) == (
+        'List files.\n\n    Example:\n        ls.py -l /tmp\n\n    Notes\n'
+        '    -----\n    Hidden files are skipped.', {})
+
+
+def test_numpy_docstring():
+    from opterator import parse_docstring
+    doc = '''Copy a file.
+
+    Parameters
+    ----------
+    source : str
+        the file to copy
+    suffix, backup_suffix : str, optional
+        -S --suffix the backup suffix
+    *others
+        more files
+
+    Returns
+    -------
+    int
+        the status
+    '''
+    assert parse_docstring(doc) == ('Copy a file.', {
+        'source': ('the', 'file', 'to', 'copy'),
+        'suffix': ('-S', '--suffix', 'the', 'backup', 'suffix'),
+        'backup_suffix': ('-S', '--suffix', 'the', 'backup', 'suffix'),
+        'others': ('more', 'files')})
+
+
+def test_rest_docstring_memoized():
+    from opterator import parse_docstring
+    doc = '''A script. :param source: the source
+        :param str dest: the
+            destination :param verbose: -v be chatty'''
+    parsed = parse_docstring(doc)
+    assert parsed == ('A script.', {
+        'source': ('the', 'source'),
+        'dest': ('the', 'destination'),
+        'verbose': ('-v', 'be', 'chatty')})
+    assert parse_docstring(doc) is parsed
+
+
+def test_command_spec():
+    from opterator import CommandSpec
+
+    def main(source, dest, mode=['fast', 'slow'], tags=[], *others):
+        '''Copy things.
+        :param source: where from
+        :param mode: -m how to go'''
+    spec = CommandSpec.from_function(main)
+    assert spec.name == 'main'
+    assert spec.description == 'Copy things.'
+    assert [p.name for p in spec.params] == [
+        'source', 'dest', 'mode', 'tags', 'others']
+    assert [p.kind for p in spec.params] == [
+        'positional', 'positional', 'option', 'option', 'varargs']
+    assert [p.position for p in spec.params] == [0, 1, 2, 3, 4]
+    assert spec.positional[0].help == 'where from'
+    mode, tags = spec.options
+    assert mode.names == ('-m',)
+    assert mode.choices == ['fast', 'slow']
+    assert tags.names == ('-t', '--tags')
+    assert tags.action == 'append'
+    assert tags.default is main.__defaults__[1]
+    assert spec.varargs.name == 'others'
+    assert spec.arguments({'source': 'a', 'dest': 'b', 'mode': 'slow',
+                           'tags': [], 'others': ['c']}) == (
+        'a', 'b', 'slow', [], 'c')
+
+    @opterate
+    def command(source):
+        pass
+    assert command.spec().arguments({'source': 'a'}) == ('a',)
+    assert command._parser is None
+
+
+def test_typed_options():
+    import pathlib
+    result = Checker()
+
+    @opterate
+    def main(count=1, ratio=0.5, path=pathlib.Path('.'), name='x',
+             sizes=[1, 2]):
+        result.values = (count, ratio, path, name, sizes)
+    main(['-c', '3', '-r', '2.5', '-p', 'a/b', '-n', '4', '-s', '2'])
+    assert result.values == (3, 2.5, pathlib.Path('a/b'), '4', 2)
+    with pytest.raises(SystemExit):
+        main(['-c', 'three'])
+
+
+def test_annotated_types():
+    result = Checker()
+
+    def main(first, scale=1, offset=None):
+        result.values = (first, scale, offset)
+    main.__annotations__ = {'first': int, 'scale': ['-x', float]}
+    main = opterate(main)
+    main(['2', '-x', '4'])
+    assert result.values == (2, 4.0, None)
+
+
+def test_annotations_that_are_not_converters():
+    import typing
+    result = Checker()
+
+    def main(name, verbose=False, quiet=True, tags=[], count=None, *rest):
+        result.values = (name, verbose, quiet, tags, count, rest)
+    main.__annotations__ = {
+        'name': str, 'verbose': bool, 'quiet': bool, 'tags': list,
+        'count': typing.Optional[int], 'rest': typing.List[str]}
+    for engine in ('argparse', 'fast'):
+        command = opterate(main, engine=engine)
+        command(['a', 'b', '-v', '-q', '-t', 'x', '-t', 'yz', '-c', '3'])
+        assert result.values == (
+            'a', True, False, ['x', 'yz'], '3', ('b',))
+        command(['a'])
+        assert result.values == ('a', False, True, [], None, ())
+
+
+def test_vectorize_array():
+    import array
+    result = Checker()
+
+    def main(weights=[]):
+        result.weights = weights
+    main.__annotations__ = {'weights': float}
+    command = opterate(main, vectorize='array')
+    command(['-w', '1', '-w', '2.5'])
+    assert result.weights == array.array('d', [1.0, 2.5])
+    with pytest.raises(SystemExit):
+        command(['-w', '1', '-w', 'heavy'])
+    fast = opterate(main, vectorize='array', engine='fast')
+    fast(['-w', '3'])
+    assert result.weights == array.array('d', [3.0])
+
+
+def test_vectorize_numpy():
+    numpy = pytest.importorskip('numpy')
+    result = Checker()
+
+    def main(ids=[]):
+        result.ids = ids
+    main.__annotations__ = {'ids': int}
+    opterate(main, vectorize='numpy')(['-i', '4', '-i', '5'])
+    assert result.ids.dtype == numpy.int64
+    assert list(result.ids) == [4, 5]
+
+
+def test_stream_varargs(tmpdir, monkeypatch, capsys):
+    import io
+    import opterator
+    result = Checker()
+    listing = tmpdir.join('files.txt')
+    listing.write('a.txt\n\nb.txt\r\n')
+    big = tmpdir.join('big.txt')
+    big.write('\n'.join(str(i) for i in range(1000)))
+    monkeypatch.setattr(opterator, 'MMAP_THRESHOLD', 100)
+
+    @opterate(stream_varargs=True)
+    def main(verbose=False, *files):
+        result.files = files
+        result.items = list(files[0])
+    monkeypatch.setattr(sys, 'stdin', io.StringIO(u'c.txt\nd.txt\n'))
+    main(['-v', 'x', '@' + str(listing), '-', 'y'])
+    assert len(result.files) == 1
+    assert result.items == ['x', 'a.txt', 'b.txt', 'c.txt', 'd.txt', 'y']
+
+    def numbers(*values):
+        result.total = sum(values[0])
+    numbers.__annotations__ = {'values': int}
+    for engine in ('argparse', 'fast'):
+        command = opterate(numbers, stream_varargs=True, engine=engine)
+        command(['@' + str(big), '5'])
+        assert result.total == 499505
+        with pytest.raises(SystemExit):
+            command(['1', 'two'])
+
+    missing = str(tmpdir.join('missing.txt'))
+    for engine in ('argparse', 'fast'):
+        command = opterate(numbers, stream_varargs=True, engine=engine)
+        with pytest.raises(SystemExit) as exit:
+            command(['1', '@' + missing])
+        assert exit.value.code == 2
+        assert "argument values: can't open '%s'" % missing in (
+            capsys.readouterr()[1])
+
+
+def test_parallel_varargs(capsys):
+    import threading
+
+    @opterate(parallel='varargs', ordered_output=True)
+    def main(suffix='', jobs_seen=False, *names):
+        name, = names
+        if name == 'bad':
+            raise SystemExit(3)
+        time.sleep(0.01 if name == 'a' else 0)
+        sys.stdout.write(name + suffix + '\n')
+        sys.stderr.write(threading.current_thread().name[:4] + '\n')
+    assert main(['-s', '!', '-j', '3', 'a', 'b', 'c', 'd']) == 0
+    out, err = capsys.readouterr()
+    assert out == 'a!\nb!\nc!\nd!\n'
+    assert err.split() == ['Thre'] * 4
+    assert main(['a', 'bad', 'b']) == 3
+    assert capsys.readouterr()[0] == 'a\nb\n'
+    assert main.build().parse_args(['--jobs', '0']).opterator_jobs == 0
+    assert main.spec().options[1].names == ('-o', '--jobs_seen')
+
+    with pytest.raises(ValueError):
+        opterate(lambda name: None, parallel='varargs')(['x'])
+
+
+def test_parallel_processes(capsys):
+    @opterate(parallel='varargs', executor='process', ordered_output=True,
+              engine='fast')
+    def main(*numbers):
+        print(int(numbers[0]) * 2)
+        return int(numbers[0]) % 2
+    assert main(['-j', '2', '1', '2', '3']) == 1
+    assert capsys.readouterr()[0] == '2\n4\n6\n'
+
+
+def test_config_and_environment(tmpdir, monkeypatch):
+    result = Checker()
+    monkeypatch.setenv('OPTERATOR_CACHE_DIR', str(tmpdir.join('cache')))
+    ini = tmpdir.join('tool.ini')
+    ini.write('[main]\ncount = 3\nverbose = yes\ntags = a, b\n')
+    json_file = tmpdir.join('tool.json')
+    json_file.write('{"main": {"count": 4, "dry-run": true}}')
+
+    def main(count=1, verbose=False, dry_run=False, tags=[], name=None):
+        result.values = (count, verbose, dry_run, tags, name)
+    for engine in ('argparse', 'fast'):
+        command = opterate(main, engine=engine, env_prefix='tool', config=[
+            str(ini), str(tmpdir.join('missing.toml')), str(json_file)])
+        command([])
+        assert result.values == (4, True, True, ['a', 'b'], None)
+        monkeypatch.setenv('TOOL_NAME', 'env')
+        monkeypatch.setenv('TOOL_VERBOSE', 'off')
+        command(['-c', '5', '-t', 'c'])
+        assert result.values == (5, False, True, ['a', 'b', 'c'], 'env')
+        monkeypatch.setenv('TOOL_COUNT', 'many')
+        with pytest.raises(SystemExit):
+            command([])
+        monkeypatch.delenv('TOOL_COUNT')
+        monkeypatch.delenv('TOOL_NAME')
+        monkeypatch.delenv('TOOL_VERBOSE')
+
+
+def test_config_cache(tmpdir, monkeypatch):
+    import opterator
+    toml = tmpdir.join('tool.toml')
+    toml.write('[main]\nname = "first"\n')
+    cache = str(tmpdir.join('cache'))
+    assert opterator.read_config(str(toml), cache) == {
+        'main': {'name': 'first'}}
+    assert len(os.listdir(cache)) == 1
+    monkeypatch.setattr(opterator, '_parse_config', None)
+    assert opterator.read_config(str(toml), cache)['main']['name'] == 'first'
+    monkeypatch.undo()
+    toml.write('[main]\nname = "second"\nother = 1\n')
+    assert opterator.read_config(str(toml), cache)['main']['name'] == 'second'
+    assert opterator.read_config(str(tmpdir.join('missing'))) is None
+
+    @opterate(config=str(toml), spec_cache=cache)
+    def main(name=''):
+        pass
+    with pytest.raises(SystemExit):
+        main([])
+
+
+def test_cached_help(tmpdir, monkeypatch, capsys):
+    from opterator import Command
+
+    def main(source, verbose=False, *others):
+        '''Copy things, with a description long enough to need wrapping at
+        a narrow terminal width.
+        :param verbose: say what is happening'''
+    monkeypatch.setenv('COLUMNS', '40')
+    monkeypatch.setattr(sys, 'argv', ['copy.py'])
+    expected = Command(main).build().format_help()
+    command = Command(main, spec_cache=str(tmpdir))
+    with pytest.raises(SystemExit) as exit:
+        command(['-h'])
+    assert exit.value.code == 0
+    assert capsys.readouterr()[0] == expected
+    assert command.help_text() is command.help_text()
+
+    fresh = Command(main, spec_cache=str(tmpdir))
+    with pytest.raises(SystemExit):
+        fresh(['--help'])
+    assert capsys.readouterr()[0] == expected
+    assert fresh._parser is None and fresh._spec is None
+
+    monkeypatch.setenv('COLUMNS', '100')
+    assert fresh.help_text() == Command(main).build().format_help()
+    assert fresh.help_text() != expected
+
+    def pick(mode=['fast', 'slow']):
+        pass
+    assert 'slow' in Command(pick, spec_cache=str(tmpdir)).help_text()
+    pick.__defaults__ = (['fast', 'medium'],)
+    text = Command(pick, spec_cache=str(tmpdir)).help_text()
+    assert 'medium' in text and 'slow' not in text
+
+    # Python 2 has no shutil.get_terminal_size.
+    import shutil
+    monkeypatch.delattr(shutil, 'get_terminal_size')
+    monkeypatch.setenv('COLUMNS', '40')
+    assert Command(main, spec_cache=str(tmpdir)).help_text() == expected
+
+
+def test_direct_call():
+    def main(source, mode=['fast', 'slow'], verbose=False, *others):
+        return source, mode, verbose, others
+    command = opterate(main)
+    assert command.__wrapped__ is main
+    assert command.call(source='a') == ('a', ['fast', 'slow'], False, ())
+    assert command.call(source='a', mode='slow', verbose=True,
+                        others=iter(['b', 'c'])) == (
+        'a', 'slow', True, ('b', 'c'))
+    with pytest.raises(TypeError):
+        command.call(mode='fast')
+    with pytest.raises(TypeError):
+        command.call(source='a', colour='red')
+    with pytest.raises(ValueError):
+        command.call(source='a', mode='medium')
+    assert command._parser is None
+
+
+def test_diagnostics(tmpdir, monkeypatch):
+    import pstats
+
+    def main(count=1000, profile=False):
+        return len([str(i) for i in range(count)])
+    command = opterate(main, diagnostics=True)
+    assert '--opterator-profile' not in command.help_text()
+    assert command.spec().options[1].names == ('-p', '--profile')
+    assert command(['--profile']) == 1000
+    stats = str(tmpdir.join('main.prof'))
+    report = str(tmpdir.join('main.txt'))
+    assert command(['--opterator-profile', stats,
+                    '--opterator-tracemalloc', report]) == 1000
+    assert any(name == 'main' for (path, line, name)
+               in pstats.Stats(stats).stats)
+    assert tmpdir.join('main.txt').read().startswith('Peak traced memory')
+
+    with pytest.raises(SystemExit):
+        opterate(main)(['--opterator-tracemalloc', report])
+    monkeypatch.setenv('OPTERATOR_DIAGNOSTICS', '1')
+    for engine in ('argparse', 'fast'):
+        command = opterate(main, engine=engine)
+        assert command(['--opterator-tracemalloc', report, '-p']) == 1000
+        assert command(['--profile']) == 1000
+
+
+def test_telemetry(tmpdir, monkeypatch):
+    import json
+    import socket
+    import opterator
+    log = tmpdir.join('usage.jsonl')
+    monkeypatch.setenv('OPTERATOR_TELEMETRY', str(log))
+
+    @opterate
+    def main(name, count=1, verbose=False):
+        if name == 'fail':
+            sys.exit(3)
+        return [name] * count
+    assert main(['a', '-c', '2']) == ['a', 'a']
+    with pytest.raises(SystemExit):
+        main(['fail'])
+    with pytest.raises(SystemExit):
+        main([])
+    opterator.flush_telemetry()
+    records = [json.loads(line) for line in log.readlines()]
+    assert [(r['command'], r['options'], r['status']) for r in records] == [
+        ('main', ['count'], 1), ('main', [], 3), ('main', None, 2)]
+    assert all(record['wall_ns'] > 0 for record in records)
+    if 'max_rss_kb' in records[0]:
+        assert records[0]['max_rss_kb'] > 0
+
+    path = str(tmpdir.join('telemetry.sock'))
+    receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    receiver.bind(path)
+    receiver.settimeout(5)
+    opterate(main.__wrapped__, telemetry='unix:' + path)(['b'])
+    assert json.loads(receiver.recv(65536).decode('utf-8'))['status'] == 1
+    receiver.close()
+
+
+def test_compile(tmpdir, monkeypatch):
+    import subprocess
+    from opterator import _main
+    tmpdir.join('tool.py').write(
+        'import sys\n'
+        'from opterator import opterate\n'
+        '\n'
+        '\n'
+        '@opterate\n'
+        'def main(source, count=1, mode=["fast", "slow"], *rest):\n'
+        '    """Do things.\n'
+        '    :param mode: -m how to go"""\n'
+        '    print((source, count, mode, rest, "argparse" in sys.modules))\n'
+        '    return count\n')
+    monkeypatch.syspath_prepend(str(tmpdir))
+    monkeypatch.setattr(sys, 'argv', ['opterator.py'])
+    monkeypatch.delitem(sys.modules, 'tool', raising=False)
+    path = list(sys.path)
+    output = str(tmpdir.join('tool_cli.py'))
+    try:
+        assert _main(['compile', 'tool:main', '-o', output]) is None
+    finally:
+        sys.modules.pop('tool', None)
+    assert sys.argv == ['opterator.py']
+    assert sys.path == path
+    source = tmpdir.join('tool_cli.py').read()
+    assert "'-m': ('mode', 'store', DEFAULTS[1], None)," in source
+
+    environ = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [str(tmpdir), os.path.dirname(os.path.dirname(__file__))]))
+    run = subprocess.Popen(
+        [sys.executable, output, 'a', 'b', '-c', '3', '-m', 'slow'],
+        stdout=subprocess.PIPE, env=environ)
+    assert run.communicate()[0].decode() == (
+        "('a', 3, 'slow', ('b',), False)\n")
+    run = subprocess.Popen(
+        [sys.executable, output, '-h'], stdout=subprocess.PIPE, env=environ)
+    assert run.communicate()[0].decode().startswith(
+        'usage: tool_cli.py [-h] [-c COUNT] [-m {fast,slow}]')
+    run = subprocess.Popen(
+        [sys.executable, output, 'a', '-m', 'medium'],
+        stderr=subprocess.PIPE, env=environ)
+    assert b'invalid choice' in run.communicate()[1]
+    assert run.returncode == 2
+
+    @opterate(parallel='varargs')
+    def parallel(*items):
+        pass
+    from opterator import compile_command
+    with pytest.raises(ValueError):
+        compile_command(parallel, 'tool:parallel', 'tool')
+
+    @opterate(cache=str(tmpdir.join('results')))
+    def cached(name):
+        pass
+    with pytest.raises(ValueError):
+        compile_command(cached, 'tool:cached', 'tool')
+
+
+def test_concurrent_invoke(capsys):
+    import threading
+    from opterator import ParseError
+
+    def main(name, count=1, mode=['fast', 'slow'], *rest):
+        return name, count, mode, rest
+    for engine in ('argparse', 'fast'):
+        command = opterate(main, engine=engine)
+        start = threading.Barrier(16)
+        failures = []
+
+        def hammer(number):
+            start.wait()
+            try:
+                for i in range(200):
+                    name = '%d-%d' % (number, i)
+                    assert command.invoke([name, 'x', '-c', str(i)]) == (
+                        name, i, ['fast', 'slow'], ('x',))
+                    assert command.parse([name, '-m', 'slow'])['mode'] == (
+                        'slow')
+                    with pytest.raises(ParseError) as error:
+                        command.invoke([name, '-c', 'many'])
+                    assert error.value.status == 2
+                    assert "invalid int value: 'many'" in error.value.output
+                    with pytest.raises(ParseError) as error:
+                        command.invoke(['--help'])
+                    assert error.value.status == 0
+                    assert error.value.output.startswith('usage:')
+            except Exception as error:
+                failures.append(error)
+        threads = [threading.Thread(target=hammer, args=(number,))
+                   for number in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert failures == []
+    assert capsys.readouterr() == ('', '')
+
+
+def test_pickle_command():
+    import pickle
+    import multiprocessing
+    from concurrent import futures
+    assert pickle.loads(pickle.dumps(picklable_command)) is picklable_command
+    context = multiprocessing.get_context('spawn')
+    with futures.ProcessPoolExecutor(2, mp_context=context) as pool:
+        pids = list(pool.map(picklable_command.invoke,
+                             [['a'], ['b', '-c', '2']]))
+    assert os.getpid() not in pids
+
+    @opterate
+    def local(word):
+        pass
+    with pytest.raises(pickle.PicklingError):
+        pickle.dumps(local)
+    results = list(picklable_command.run_many(
+        [['x', '-c', '2'], ['y']], workers=2, executor='process'))
+    assert [result.value != os.getpid() for result in results] == [
+        True, True]
+
+
+def test_result_cache(tmpdir, capsys):
+    calls = []
+    source = tmpdir.join('input.txt')
+    source.write('hello')
+    cache = str(tmpdir.join('results'))
+
+    def main(path, upper=False, status=0):
+        calls.append(path)
+        text = open(path).read()
+        print(text.upper() if upper else text)
+        sys.stderr.write('read %s\n' % path)
+        if status:
+            sys.exit(int(status))
+        return len(text)
+    for files in ('mtime', 'hash'):
+        del calls[:]
+        command = opterate(main, cache=cache, cache_files=files)
+        assert command([str(source)]) == 5
+        assert command([str(source)]) == 5
+        assert command([str(source), '-u']) == 5
+        assert len(calls) == 2
+        assert capsys.readouterr() == (
+            'hello\nhello\nHELLO\n', 'read %s\n' % source * 3)
+        with pytest.raises(SystemExit) as exit:
+            command([str(source), '-s', '3'])
+        with pytest.raises(SystemExit) as exit:
+            command([str(source), '-s', '3'])
+        assert exit.value.code == 3
+        assert len(calls) == 3
+        source.write('changed')
+        assert command([str(source)]) == 7
+        assert len(calls) == 4
+        source.write('hello')
+        capsys.readouterr()
+
+    small = opterate(main, cache=cache, cache_size=0)
+    small([str(source)])
+    assert os.listdir(cache) == []
+
+
+def test_parallel_result_cache(tmpdir, capsys):
+    calls = []
+
+    def main(*names):
+        calls.append(names)
+        print('item %s' % names[0])
+        sys.stderr.write('done %s\n' % names[0])
+    for executor in ('thread', 'process'):
+        del calls[:]
+        command = opterate(main, cache=str(tmpdir.join(executor)),
+                           parallel='varargs', executor=executor)
+        assert command(['-j', '2', 'a', 'b']) == 0
+        first = capsys.readouterr()
+        assert first == ('item a\nitem b\n', 'done a\ndone b\n')
+        assert command(['-j', '2', 'a', 'b']) == 0
+        assert capsys.readouterr() == first
+        if executor == 'thread':
+            assert len(calls) == 2
+
+
+def test_concurrent_result_cache(tmpdir, capsys):
+    import threading
+    cache = str(tmpdir.join('results'))
+
+    def main(name, count=1):
+        for i in range(count):
+            print('%s %d' % (name, i))
+            sys.stderr.write('%s\n' % name)
+            time.sleep(0.001)
+        return name
+    command = opterate(main, cache=cache)
+    start = threading.Barrier(8)
+    failures = []
+
+    def hammer(number):
+        start.wait()
+        try:
+            for i in range(20):
+                name = '%d-%d' % (number, i % 5)
+                assert command.invoke([name, '-c', '10']) == name
+        except Exception as error:
+            failures.append(error)
+    threads = [threading.Thread(target=hammer, args=(number,))
+               for number in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert failures == []
+    import opterator
+    assert not isinstance(sys.stdout, opterator._StreamRouter)
+    capsys.readouterr()
+    for number in range(8):
+        for i in range(5):
+            name = '%d-%d' % (number, i)
+            assert command([name, '-c', '10']) == name
+            assert capsys.readouterr() == (
+                ''.join('%s %d\n' % (name, j) for j in range(10)),
+                '%s\n' % name * 10)
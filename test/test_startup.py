@@ -0,0 +1,41 @@
+'''Guard the cost of importing opterator and decorating an entry point, which
+is paid by every script that uses it, even when it only prints help.'''
+import os
+import subprocess
+import sys
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that opterator may add to a bare interpreter at import time.
+IMPORT_BUDGET = set(['opterator'])
+
+
+def run_python(code, *options):
+    env = dict(os.environ, PYTHONPATH=PACKAGE_DIR)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return subprocess.check_output(
+        (sys.executable,) + options + ('-c', code),
+        env=env, stderr=subprocess.STDOUT, universal_newlines=True)
+
+
+def new_modules(code):
+    output = run_python(
+        'import sys\n'
+        'before = set(sys.modules)\n'
+        + code +
+        '\nprint(" ".join(sorted(set(sys.modules) - before)))')
+    return set(output.split())
+
+
+def test_import_module_budget():
+    assert new_modules('import opterator') <= IMPORT_BUDGET
+
+
+def test_decorate_does_not_import_argparse():
+    modules = new_modules(
+        'from opterator import opterate\n'
+        '@opterate\n'
+        'def main(source, dest, verbose=False, *others):\n'
+        '    """:param verbose: -v --verbose be chatty"""\n')
+    assert modules <= IMPORT_BUDGET
+